@@ -3,15 +3,20 @@ import sqlite3
 import subprocess
 import sys
 import time
-import textwrap
 import re
 import json
 import os
+import logging
 from pathlib import Path
 from math import ceil
+from collections import namedtuple
+from functools import lru_cache
 import shlex
 import threading
+import signal
+import queue
 import webbrowser
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 
 # --- IMPORTS for API Server ---
 from flask import Flask, jsonify, request
@@ -28,6 +33,21 @@ except ImportError as e:
     print("Please install necessary packages (e.g., pip install streamdeck Pillow Flask Flask-CORS)", file=sys.stderr)
     sys.exit(1)
 
+# --- OPTIONAL: in-process AppleScript via PyObjC, opt-in with SD_INPROCESS_OSA=1 (default spawns osascript) ---
+objc, NSAppleScript = None, None
+if os.environ.get("SD_INPROCESS_OSA") == "1":
+    try:
+        import objc
+        from Foundation import NSAppleScript
+    except ImportError:
+        objc, NSAppleScript = None, None
+
+# --- OPTIONAL: waitress serves the config API (falls back to Flask's development server) ---
+try:
+    from waitress import serve as waitress_serve
+except ImportError:
+    waitress_serve = None
+
 # === Application Directories & Files ===
 APP_DIR = Path.home() / "Library" / "StreamDeckDriver"
 APP_DIR.mkdir(parents=True, exist_ok=True)
@@ -36,10 +56,36 @@ LOAD_SCRIPT = APP_DIR / "streamdeck_db.py"
 SCRIPTS_DIR = APP_DIR / "scripts"
 SCRIPTS_DIR.mkdir(parents=True, exist_ok=True)
 WEB_UI_DIR = APP_DIR / "browsebuttons"
+SSH_CONTROL_DIR = APP_DIR / "ssh"
+SSH_CONTROL_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+# Monitor checks share one multiplexed connection per host instead of a fresh TCP+auth handshake each poll.
+SSH_MUX_OPTS = f"-o ControlMaster=auto -o ControlPath={shlex.quote(str(SSH_CONTROL_DIR / '%C'))} -o ControlPersist=600"
+
+# Per-press chatter goes through this logger (level from SD_LOG, e.g. SD_LOG=INFO); startup and errors still print.
+SD_LOG_LEVEL = logging.getLevelName(os.environ.get("SD_LOG", "WARNING").upper())
+if not isinstance(SD_LOG_LEVEL, int):
+    print(f"[WARNING] Unknown SD_LOG level '{os.environ.get('SD_LOG')}', using WARNING.", file=sys.stderr); SD_LOG_LEVEL = logging.WARNING
+logging.basicConfig(level=SD_LOG_LEVEL, format="[%(levelname)s] %(message)s")
+log = logging.getLogger("streamdeck")
 
 
 # === In-memory storage for variables ===
-current_session_vars = {}
+class SessionVars(dict):
+    """Session variable dict that bumps `version` on every mutation, so resolved commands can be memoized.
+    Values are stored as strings, so readers never need str()."""
+    version = 0
+    def __init__(self, *args, **kwargs): super().__init__(); self.update(*args, **kwargs)
+    def __setitem__(self, key, value): super().__setitem__(key, str(value)); self.version += 1
+    def __delitem__(self, key): super().__delitem__(key); self.version += 1
+    def update(self, *args, **kwargs): super().update({k: str(v) for k, v in dict(*args, **kwargs).items()}); self.version += 1
+    def setdefault(self, key, default=None):
+        if key not in self: self[key] = default
+        return self[key]
+    def pop(self, key, *default): self.version += 1; return super().pop(key, *default)
+    def popitem(self): self.version += 1; return super().popitem()
+    def clear(self): super().clear(); self.version += 1
+
+current_session_vars = SessionVars()
 at_devices_to_reinit_cmd = set()
 numeric_step_memory = {}
 record_toggle_states = {}
@@ -48,23 +94,32 @@ background_processes = {}
 # === Variable Pattern (Permissive) ===
 VAR_PATTERN = re.compile(r"\{\{([^:}]+)(:([^}]*))?\}\}")
 SSH_USER_HOST_CMD_PATTERN = re.compile(r"^(ssh(?:\s+-[a-zA-Z0-9]+(?:\s+\S+)?)*)\s+(\S+)@(\S+)((?:\s+.*)?)$", re.IGNORECASE)
+TAKE_VAR_PATTERN = re.compile(r"\{\{TAKE(:[^}]*)?\}\}", re.IGNORECASE)
+TAKE_DEFAULT_PATTERN = re.compile(r"\{\{TAKE:([^}]+)\}\}", re.IGNORECASE)
+FONT_SIZE_PATTERN = re.compile(r"(\d+)")
+STATEFUL_APPLESCRIPT_PATTERN = re.compile(r"^\s*(property|global)\b", re.IGNORECASE | re.MULTILINE)
+ERE_SPECIAL_PATTERN = re.compile(r"[\\.\[\]()*+?{}|^$]")
+REC_START_OUTPUT_PATTERN = re.compile(r"(Will capture.*?Session start status: 0)", re.DOTALL)
+
 
 
 # === Monitoring State Dictionaries ===
 monitor_states = {}
 monitor_threads = {}
-key_to_global_item_idx_map = {}
 global_item_idx_to_key_map = {}
 monitor_generations = {}
 
 
 # === Configuration & Constants ===
-POLL_INTERVAL = 0.3
+FLASH_INTERVAL = 0.5
+API_REBUILD_DEBOUNCE = 0.05
+DIALOG_GIVE_UP_SECS = 120 # Unanswered chained prompts give up, so a forgotten dialog doesn't hold the dialog worker
 LINE_SPACING = 2
 VAR_LINE_SPACING = 1
 DEFAULT_FONT_SIZE = 13
 ARROW_FONT_SIZE = 24
 LONG_PRESS_THRESHOLD = 1.0
+LONG_PRESS_THRESHOLD_NS = int(LONG_PRESS_THRESHOLD * 1e9)
 FONT_PATH = "/System/Library/Fonts/SFNS.ttf"
 BOLD_FONT_PATH = "/System/Library/Fonts/SFNSDisplay-Bold.otf"
 BASE_COLORS = {
@@ -73,13 +128,25 @@ BASE_COLORS = {
     'S': '#C0C0C0', 'F': '#FF00FF', 'W': '#FFFFFF',
     'L': '#FDF6E3'
 }
+NON_COLOR_FLAGS = frozenset('NT@D#V~KM?*&>')
+COLOR_FLAG_CHARS = frozenset(BASE_COLORS) - NON_COLOR_FLAGS
+# Light base colours that always get black text, whatever their luminance works out to.
+BLACK_TEXT_BGS = frozenset(BASE_COLORS[c] for c in "YSWLP" if c in BASE_COLORS)
 CONFIG_SERVER_PORT = 8765
 REACT_APP_DEV_PORT = 5173
 
 # === Key globals ===
-labels, cmds, flags = {}, {}, {}
+# Indexed by physical key number; build_page allocates them at deck size.
+labels, cmds, flags = [], [], []
+# Per-key button config captured by build_page, so the key handler doesn't re-derive it per press.
+# mask holds the raw flag characters the handler branches on; parsed is the parse_flags tuple.
+FLAG_V, FLAG_HASH, FLAG_N, FLAG_AT, FLAG_M, FLAG_OSA = 1, 2, 4, 8, 16, 32
+KeyCfg = namedtuple("KeyCfg", "g_idx label cmd flags mask parsed")
+key_cfg = []
+var_users = {} # var name -> keys whose image shows that var ('V' keys show their command's vars, record keys show TAKE)
 page_index = 0
 numeric_mode, numeric_var = False, None
+control_key_actions = {} # (key, long_press) -> action, see build_control_key_actions
 active_device_key = None
 press_times = {}
 toggle_keys = set()
@@ -88,30 +155,147 @@ flash_state = False
 deck = None
 items = []
 web_ui_process = None
+stop_event = threading.Event() # Set by SIGINT/SIGTERM to end the main loop
+# Set whenever the key images may need to start animating; the idle main loop blocks on it.
+ui_wake = threading.Event()
+# Keys whose state changed off the key-press path (monitor threads); the main loop repaints just these.
+dirty_keys = set()
+# Monotonic deadline set by API edits; the main loop rebuilds the page once per burst instead of once per request.
+page_rebuild_due = None
+# Last image pushed to each key, so unchanged keys aren't re-sent over USB.
+last_key_images = {}
+# USB writes happen on one writer thread (started in __main__); renders just queue the latest image per key.
+_key_image_writer = None
+_pending_images, _pending_images_lock, _pending_images_ready = {}, threading.Lock(), threading.Event()
+# Cumulative time per hot section; `kill -USR1 <pid>` prints and resets them.
+prof_stats = dict.fromkeys(("render_ns", "usb_ns", "cb_ns", "flash_ns", "renders", "usb_writes", "callbacks"), 0)
+db_reloading = False # True while reload_in_background is rebuilding the DB
+FLASHING_MONITOR_STATES = {'OSA_MONITORING', 'OSA_FOUND', 'connected', 'BROKEN'}
+# g_idx values whose monitor state is in FLASHING_MONITOR_STATES, maintained by set_monitor_state.
+flashing_monitors = set()
+# Key presses and dialog results both mutate the driver state; state_lock serializes them.
+state_lock = threading.RLock()
+
+class SerialWorker:
+    """One daemon thread running submitted calls in order; submit() returns a Future like an executor's.
+    Unlike ThreadPoolExecutor's workers it isn't joined at exit, so an open dialog or a running terminal
+    script doesn't keep the process (and the API port) alive after SIGINT/SIGTERM."""
+    def __init__(self, name):
+        self.jobs = queue.Queue(); threading.Thread(target=self._loop, name=name, daemon=True).start()
+    def submit(self, fn, *args, **kwargs):
+        future = Future(); self.jobs.put((fn, args, kwargs, future)); return future
+    def _loop(self):
+        while True:
+            fn, args, kwargs, future = self.jobs.get()
+            if not future.set_running_or_notify_cancel(): continue
+            try: future.set_result(fn(*args, **kwargs))
+            except Exception as e: future.set_exception(e)
+
+_dialog_executor = SerialWorker("sd-dialog")
+# Terminal AppleScripts run one at a time, in press order, off the deck callback thread.
+_terminal_executor = SerialWorker("sd-terminal")
 
 # --- HELPER & CORE FUNCTIONS ---
 
+@lru_cache(maxsize=512)
 def applescript_escape_string(s):
     s = str(s); s = s.replace('“', '"').replace('”', '"'); s = s.replace('\\', '\\\\'); s = s.replace('\n', '\\n'); s = s.replace('"', '\\"'); return s
 
-def load_applescript_template(template_filename, **kwargs):
+# template_filename -> [path, mtime, content, last_checked]; the file is re-stat'ed at most every
+# TEMPLATE_RECHECK_SECS so edited scripts are still picked up without a restart.
+_template_cache = {}
+TEMPLATE_RECHECK_SECS = 5.0
+
+def _resolve_applescript_template(template_filename):
     primary_name_has_ext = "." in os.path.basename(template_filename); potential_filenames = []
     if primary_name_has_ext: potential_filenames.append(template_filename)
     base_filename, current_ext = os.path.splitext(template_filename)
     if current_ext != ".applescript": potential_filenames.append(f"{base_filename}.applescript")
     if current_ext != ".txt": potential_filenames.append(f"{base_filename}.txt")
     if base_filename != template_filename and not primary_name_has_ext: potential_filenames.append(base_filename)
-    filepath_to_use = None; seen = set(); unique_potential_filenames = [x for x in potential_filenames if not (x in seen or seen.add(x))]
+    seen = set(); unique_potential_filenames = [x for x in potential_filenames if not (x in seen or seen.add(x))]
     for fname in unique_potential_filenames:
         filepath_scripts = SCRIPTS_DIR / fname
-        if filepath_scripts.exists(): filepath_to_use = filepath_scripts; break
+        if filepath_scripts.exists(): return filepath_scripts
         filepath_appdir = APP_DIR / fname
-        if filepath_appdir.exists(): filepath_to_use = filepath_appdir; break
-    if not filepath_to_use: raise FileNotFoundError(f"AS template not found from '{template_filename}'")
+        if filepath_appdir.exists(): return filepath_appdir
+    raise FileNotFoundError(f"AS template not found from '{template_filename}'")
+
+def _read_applescript_template(template_filename):
+    now = time.monotonic(); entry = _template_cache.get(template_filename)
+    if entry:
+        if now - entry[3] < TEMPLATE_RECHECK_SECS: return entry[2]
+        try:
+            if entry[0].stat().st_mtime == entry[1]: entry[3] = now; return entry[2]
+        except OSError: pass
+    filepath_to_use = _resolve_applescript_template(template_filename)
+    mtime = filepath_to_use.stat().st_mtime
     with open(filepath_to_use, 'r', encoding='utf-8') as f: template_content = f.read()
+    _template_cache[template_filename] = [filepath_to_use, mtime, template_content, now]
+    return template_content
+
+def load_applescript_template(template_filename, **kwargs):
+    template_content = _read_applescript_template(template_filename)
     for key, value in kwargs.items(): template_content = template_content.replace("{{" + str(key) + "}}", str(value))
     return template_content
 
+# --- In-process AppleScript (experimental, SD_INPROCESS_OSA=1) ---
+# Apple lists NSAppleScript as main-thread-only; this path runs it on one worker thread instead, which is
+# why it is opt-in. Without it every script is its own `osascript -` process, as before.
+# Compiled scripts are reused for repeated sources, except ones declaring top-level properties or globals:
+# a reused instance keeps their values between runs, while each osascript run starts fresh.
+# Dialogs run as osascript subprocesses either way, so a prompt left open doesn't stall terminal and monitor scripts.
+# A script can't be interrupted once NSAppleScript runs it, so after a timeout the worker is treated as
+# wedged: queued and new scripts go to killable osascript subprocesses until the worker finishes a script.
+_osa_jobs, _osa_wedged = queue.Queue(), threading.Event()
+
+def _new_applescript(script):
+    return NSAppleScript.alloc().initWithSource_(script)
+
+_compile_applescript = lru_cache(maxsize=64)(_new_applescript)
+
+def _run_applescript_in_process(script):
+    with objc.autorelease_pool():
+        compiled = _new_applescript(script) if STATEFUL_APPLESCRIPT_PATTERN.search(script) else _compile_applescript(script)
+        result, error = compiled.executeAndReturnError_(None)
+        if error is not None:
+            return subprocess.CompletedProcess(["osascript", "-"], 1, "", f"execution error: {error.get('NSAppleScriptErrorMessage', '')} ({error.get('NSAppleScriptErrorNumber', -1)})")
+        return subprocess.CompletedProcess(["osascript", "-"], 0, (result.stringValue() or "") if result is not None else "", "")
+
+def _osa_worker_loop():
+    while True:
+        script, future = _osa_jobs.get()
+        if not future.set_running_or_notify_cancel(): continue
+        try: future.set_result(_run_applescript_in_process(script))
+        except Exception as e: future.set_exception(e)
+        finally: _osa_wedged.clear()
+
+def _run_osascript_subprocess(script, timeout=None):
+    return subprocess.run(["osascript", "-"], input=script, text=True, capture_output=True, check=False, timeout=timeout)
+
+def _run_osascript_into(script, future):
+    try: future.set_result(_run_osascript_subprocess(script))
+    except Exception as e: future.set_exception(e)
+
+def _mark_osa_wedged():
+    """Moves scripts still queued behind a timed-out one onto subprocesses."""
+    _osa_wedged.set()
+    while True:
+        try: script, future = _osa_jobs.get_nowait()
+        except queue.Empty: return
+        if future.set_running_or_notify_cancel(): threading.Thread(target=_run_osascript_into, args=(script, future), daemon=True).start()
+
+if NSAppleScript is not None:
+    threading.Thread(target=_osa_worker_loop, name="sd-osa", daemon=True).start()
+
+def run_osascript(script, timeout=None, dialog=False):
+    """Runs AppleScript source and returns a CompletedProcess, like subprocess.run(["osascript", "-"]).
+    Raises subprocess.TimeoutExpired if the script doesn't finish within `timeout` seconds."""
+    if NSAppleScript is None or dialog or _osa_wedged.is_set(): return _run_osascript_subprocess(script, timeout)
+    future = Future(); _osa_jobs.put((script, future))
+    try: return future.result(timeout=timeout)
+    except FutureTimeoutError: future.cancel(); _mark_osa_wedged(); raise subprocess.TimeoutExpired(["osascript", "-"], timeout)
+
 # ##################################################################
 # ##### NEW FUNCTION TO RUN INITIAL SETUP APPLESCRIPTS #####
 # ##################################################################
@@ -168,30 +352,48 @@ def run_initial_setup_scripts():
 def execute_applescript_dialog(prompt_message, default_answer=""):
     script_vars = {"prompt_message": applescript_escape_string(prompt_message), "default_answer": applescript_escape_string(str(default_answer))}
     script = load_applescript_template("system_events_dialog.applescript", **script_vars)
-    proc = subprocess.run(["osascript", "-"], input=script, text=True, capture_output=True, check=False)
+    proc = run_osascript(script, dialog=True)
     if proc.returncode == 0:
         output = proc.stdout.strip()
         if output.startswith("APPLETSCRIPT_ERROR:"): print(f"[ERROR] AS Dialog Error: {output}"); return None
-        if "USER_CANCELLED_PROMPT" == output: return "USER_CANCELLED_PROMPT"
-        if "USER_TIMEOUT_PROMPT" == output: return "USER_TIMEOUT_PROMPT"
+        if output in ("USER_CANCELLED_PROMPT", "USER_TIMEOUT_PROMPT"): return None
         return output
     else:
         stderr_lower = proc.stderr.lower()
-        if proc.returncode == 1 and "(-128)" in stderr_lower: return "USER_CANCELLED_PROMPT"
-        if "(-1712)" in stderr_lower: return "USER_TIMEOUT_PROMPT"
+        if (proc.returncode == 1 and "(-128)" in stderr_lower) or "(-1712)" in stderr_lower: return None # Cancelled or timed out
         print(f"[ERROR] osascript dialog error. RC:{proc.returncode},Err:{proc.stderr.strip()},Out:{proc.stdout.strip()}"); return None
 
+def execute_applescript_multi_dialog(prompts, stop_on_cancel=False):
+    """Asks a sequence of (prompt, default) text dialogs in one AppleScript run instead of one run per prompt.
+    Returns one answer per prompt: None where the user cancelled, and for every later prompt if stop_on_cancel.
+    A prompt left unanswered for DIALOG_GIVE_UP_SECS ends the run with every answer None."""
+    if not prompts: return []
+    asks = [(f'set _r to (display dialog "{applescript_escape_string(p)}" default answer "{applescript_escape_string(str(d))}" giving up after {DIALOG_GIVE_UP_SECS})',
+             "if gave up of _r then error number -1712", "set end of _answers to text returned of _r") for p, d in prompts]
+    if stop_on_cancel: body = ["try", *("    " + line for a in asks for line in a), "on error number -128", "end try"]
+    else: body = [line for a in asks for line in ("try", *("    " + l for l in a), "on error number -128", "    set end of _answers to ASCII character 30", "end try")]
+    script = "\n".join(["set _answers to {}", 'tell application "System Events"', "activate", *body, "end tell",
+                        "set AppleScript's text item delimiters to ASCII character 31",
+                        "return ((count of _answers) as text) & (ASCII character 29) & (_answers as text)"])
+    proc = run_osascript(script, dialog=True)
+    if proc.returncode != 0:
+        if "(-128)" not in proc.stderr and "(-1712)" not in proc.stderr: print(f"[ERROR] osascript dialog error. RC:{proc.returncode},Err:{proc.stderr.strip()}")
+        return [None] * len(prompts)
+    count, _, joined = proc.stdout.rstrip("\n").partition("\x1d")
+    answers = [None if a == "\x1e" else a for a in joined.split("\x1f")] if count.strip() not in ("", "0") else []
+    return (answers + [None] * len(prompts))[:len(prompts)]
+
 def execute_applescript_confirm(prompt_message):
     script_vars = {"prompt_message": applescript_escape_string(prompt_message)}
     script = load_applescript_template("system_events_confirm.applescript", **script_vars)
-    proc = subprocess.run(["osascript", "-"], input=script, text=True, capture_output=True, check=False)
+    proc = run_osascript(script, dialog=True)
     return proc.stdout.strip() == "YES_CONFIRMED"
 
 def get_active_terminal_window_name():
     """Returns the name of the frontmost terminal window."""
     try:
         script = load_applescript_template("get_active_terminal_window.applescript")
-        proc = subprocess.run(["osascript", "-"], input=script, text=True, capture_output=True, check=False, timeout=2)
+        proc = run_osascript(script, timeout=2)
         if proc.returncode == 0 and proc.stdout.strip() and proc.stdout.strip() != "NO_WINDOW":
             return proc.stdout.strip()
     except Exception as e:
@@ -203,7 +405,7 @@ def activate_terminal_window(window_name):
     if not window_name: return
     try:
         script = load_applescript_template("activate_terminal_window.applescript", window_name=window_name)
-        subprocess.run(["osascript", "-"], input=script, text=True, check=False, timeout=2)
+        run_osascript(script, timeout=2)
     except Exception as e:
         print(f"[ERROR] Failed to activate terminal window '{window_name}': {e}", file=sys.stderr)
     
@@ -212,7 +414,7 @@ def get_terminal_output(window_title):
     script_vars = {"safe_target_title": applescript_escape_string(window_title)}
     try:
         script = load_applescript_template("terminal_check_text.applescript", **script_vars)
-        proc = subprocess.run(["osascript", "-"], input=script, text=True, capture_output=True, check=False, timeout=5)
+        proc = run_osascript(script, timeout=5)
         if proc.returncode != 0:
             print(f"[ERROR] AppleScript for getting terminal output failed: {proc.stderr.strip()}", file=sys.stderr)
             return None
@@ -228,6 +430,23 @@ def get_terminal_output(window_title):
         print(f"[ERROR] Exception while getting terminal output: {e}", file=sys.stderr)
         return None
 
+def _merge_vars_from_cmd(cmd, session_vars_dict):
+    """Adds any variables in cmd that the session doesn't have yet; existing values are kept."""
+    if not cmd: return
+    for raw_name, default in cmd_var_specs(cmd):
+        var_name, default_value = raw_name.strip(), default if default is not None else ""
+        if var_name not in session_vars_dict:
+            # Use default from command, otherwise empty string, except for TAKE
+            if var_name.upper() == 'TAKE':
+                session_vars_dict['TAKE'] = default_value or "1"
+            else:
+                session_vars_dict[var_name] = default_value
+
+def _merge_vars_from_item(item_dict, session_vars_dict):
+    _merge_vars_from_cmd(item_dict.get('command', ''), session_vars_dict)
+    if '*' in (item_dict.get('flags') or '') and 'TAKE' not in session_vars_dict:
+        session_vars_dict['TAKE'] = "1"
+
 def initialize_session_vars_from_items(items_list, session_vars_dict):
     session_vars_dict.clear()
     has_record_button = False
@@ -236,132 +455,233 @@ def initialize_session_vars_from_items(items_list, session_vars_dict):
         # Check for record flag
         if '*' in item_dict.get('flags', ''):
             has_record_button = True
-        
-        # Process command variables
-        cmd = item_dict.get('command', '')
-        if not cmd: continue
-        for match in VAR_PATTERN.finditer(cmd):
-            var_name, default_value = match.group(1).strip(), match.group(3) if match.group(3) is not None else ""
-            if var_name not in session_vars_dict:
-                # Use default from command, otherwise empty string, except for TAKE
-                if var_name.upper() == 'TAKE':
-                    session_vars_dict['TAKE'] = default_value or "1"
-                else:
-                    session_vars_dict[var_name] = default_value
+        _merge_vars_from_cmd(item_dict.get('command', ''), session_vars_dict)
 
     # If any record button exists but TAKE was not defined in any command, initialize it.
     if has_record_button and 'TAKE' not in session_vars_dict:
         session_vars_dict['TAKE'] = "1"
 
+# Memoized resolutions: template -> (session dict, dict version, resolved string)
+_resolved_cmd_cache = {}
+
 def resolve_command_string(command_str_template, session_vars_dict):
+    version = getattr(session_vars_dict, 'version', None)
+    if version is not None:
+        cached = _resolved_cmd_cache.get(command_str_template)
+        if cached and cached[0] is session_vars_dict and cached[1] == version: return cached[2]
+    resolved_cmd = _resolve_command_string_uncached(command_str_template, session_vars_dict)
+    # Only cache when resolving didn't record new defaults; otherwise the next call may resolve differently.
+    if version is not None and session_vars_dict.version == version:
+        if len(_resolved_cmd_cache) > 512: _resolved_cmd_cache.clear()
+        _resolved_cmd_cache[command_str_template] = (session_vars_dict, version, resolved_cmd)
+    return resolved_cmd
+
+@lru_cache(maxsize=512)
+def _take_substituted(command_str_template, take_repl):
+    return TAKE_VAR_PATTERN.sub(take_repl, command_str_template)
+
+@lru_cache(maxsize=1024)
+def _template_segments(text):
+    """Splits text on VAR_PATTERN once: (literal chunks, (placeholder, raw name, stripped name, default) per match).
+    There is always one more literal than placeholder; resolving is then a join with dict lookups."""
+    literals, placeholders, pos = [], [], 0
+    for m in VAR_PATTERN.finditer(text):
+        literals.append(text[pos:m.start()]); pos = m.end()
+        placeholders.append((m.group(0), m.group(1), m.group(1).strip(), m.group(3) if m.group(3) is not None else ""))
+    literals.append(text[pos:])
+    return tuple(literals), tuple(placeholders)
+
+def _resolve_command_string_uncached(command_str_template, session_vars_dict):
     resolved_cmd = command_str_template
     # Handle the global TAKE variable first
     if 'TAKE' in session_vars_dict:
-        take_val_str = str(session_vars_dict.get('TAKE', '1'))
+        take_val_str = session_vars_dict.get('TAKE', '1')
         try:
             # Pad with zeros if it's a number
             padded_take = str(int(take_val_str)).zfill(3)
-            resolved_cmd = re.sub(r'\{\{TAKE(:[^}]*)?\}\}', padded_take, resolved_cmd, flags=re.IGNORECASE)
+            resolved_cmd = _take_substituted(resolved_cmd, padded_take)
         except (ValueError, TypeError):
              # If not a number, just substitute the raw value
-            resolved_cmd = re.sub(r'\{\{TAKE(:[^}]*)?\}\}', take_val_str, resolved_cmd, flags=re.IGNORECASE)
-
-    # Handle all other variables
-    for var_name, var_value in session_vars_dict.items():
-        if var_name.upper() != 'TAKE':
-            # This regex ensures we only replace variables with the exact name
-            resolved_cmd = re.compile(r"(\{\{)(" + re.escape(var_name) + r")(:[^}]*)?(\}\})").sub(str(var_value), resolved_cmd)
-
-    # Final pass for any remaining placeholders with defaults
-    for match in list(VAR_PATTERN.finditer(resolved_cmd)):
-        full_placeholder, var_name, default_in_cmd = match.group(0), match.group(1).strip(), match.group(3) if match.group(3) is not None else ""
-        if var_name.upper() != 'TAKE' and var_name not in session_vars_dict:
-            session_vars_dict[var_name] = default_in_cmd
-            resolved_cmd = resolved_cmd.replace(full_placeholder, str(session_vars_dict.get(var_name, default_in_cmd)))
+            resolved_cmd = _take_substituted(resolved_cmd, take_val_str)
+
+    # Substitute known variables and fill defaults for unknown ones from the cached placeholder split.
+    # A name first defined by a default in this pass is only filled for that exact placeholder text.
+    literals, placeholders = _template_segments(resolved_cmd)
+    if placeholders:
+        filled, filled_names, parts = {}, set(), [literals[0]]
+        for (full_placeholder, raw_name, var_name, default), literal in zip(placeholders, literals[1:]):
+            if full_placeholder in filled: value = filled[full_placeholder]
+            elif var_name.upper() == 'TAKE': value = full_placeholder
+            elif raw_name in session_vars_dict and raw_name not in filled_names: value = session_vars_dict[raw_name]
+            elif var_name in session_vars_dict: value = full_placeholder
+            else:
+                session_vars_dict[var_name] = default
+                filled_names.add(var_name); value = filled[full_placeholder] = session_vars_dict[var_name]
+            parts.append(value); parts.append(literal)
+        resolved_cmd = "".join(parts)
 
     return resolved_cmd.replace('\\"', '"')
 
+_db = None; _db_lock = threading.Lock()
+_GET_ITEMS_SQL = "SELECT id, label, command, flags, monitor_keyword FROM streamdeck ORDER BY id"
+def db_conn():
+    """Shared autocommit connection (WAL) opened on first use; callers hold _db_lock around each statement."""
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+        _db.row_factory = sqlite3.Row
+        _db.executescript("PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA temp_store=MEMORY;")
+    return _db
+def close_db():
+    """Closes the shared connection so a DB rebuild (which deletes the file) is picked up on next use."""
+    global _db
+    with _db_lock:
+        if _db is not None:
+            try: _db.close()
+            except sqlite3.Error: pass
+            _db = None
+
 def get_items():
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row; cur = conn.cursor()
-            cur.execute("SELECT id, label, command, flags, monitor_keyword FROM streamdeck ORDER BY id")
-            return [dict(row) for row in cur.fetchall()]
+        with _db_lock: return [dict(row) for row in db_conn().execute(_GET_ITEMS_SQL)]
     except sqlite3.Error as e: print(f"[ERROR] Database read failed: {e}", file=sys.stderr); return []
 
+@lru_cache(maxsize=256)
 def parse_flags(flags_str):
     f = (flags_str or "").strip().upper()
     if not f or f == 'MISSING VALUE': return False, False, False, '#000000', DEFAULT_FONT_SIZE, False, False, False, False, False, False, False
-    new_win, device, sticky = 'N' in f, '@' in f, 'T' in f
-    font_size = int(m.group(1)) if (m := re.search(r"(\d+)", f)) else DEFAULT_FONT_SIZE
-    force_local_execution, is_mobile_ssh_flag = 'K' in f, 'M' in f
-    osa_mon_flag, record_flag = '?' in f, '*' in f
-    background_flag, confirm_flag, monitor_flag = '&' in f, '>' in f, '~' in f
+    chars = set(f)
+    new_win, device, sticky = 'N' in chars, '@' in chars, 'T' in chars
+    font_size = int(m.group(1)) if (m := FONT_SIZE_PATTERN.search(f)) else DEFAULT_FONT_SIZE
+    force_local_execution, is_mobile_ssh_flag = 'K' in chars, 'M' in chars
+    osa_mon_flag, record_flag = '?' in chars, '*' in chars
+    background_flag, confirm_flag, monitor_flag = '&' in chars, '>' in chars, '~' in chars
 
     if record_flag: is_mobile_ssh_flag = True
 
-    non_color_flags = {'N', 'T', '@', 'D', '#', 'V', '~', 'K', 'M', '?', '*', '&', '>'}
-    base_color_char = next((c for c in f if c in BASE_COLORS and c not in non_color_flags), None)
+    # First colour letter in the string wins, so the scan stays ordered rather than a set lookup.
+    base_color_char = next((c for c in f if c in COLOR_FLAG_CHARS), None) if chars & COLOR_FLAG_CHARS else None
     col = BASE_COLORS.get(base_color_char, '#000000')
 
-    if 'D' in f and base_color_char:
-        try: col = f"#{''.join(f'{int(col[i:i+2],16)//2:02X}' for i in (1,3,5))}"
-        except: pass
+    if 'D' in chars and base_color_char:
+        col = dim_color(col)
 
     return new_win, device, sticky, col, font_size, force_local_execution, is_mobile_ssh_flag, osa_mon_flag, record_flag, background_flag, confirm_flag, monitor_flag
 
+@lru_cache(maxsize=1024)
+def cmd_var_specs(cmd):
+    """(raw name, default or None) for each placeholder in a command template, in order.
+    Command templates come from a small fixed set, so callers share one scan per string."""
+    return tuple((m.group(1), m.group(3)) for m in VAR_PATTERN.finditer(cmd))
+
+@lru_cache(maxsize=256)
+def cmd_var_names(cmd):
+    """Placeholder names in a command template, in order (duplicates kept), for 'V' key display."""
+    return tuple(name.strip() for name, _ in cmd_var_specs(cmd))
+
+# KeyCfg of the active @-device, kept in step by set_active_device/build_page; label is None when none is active.
+NO_ACTIVE_DEVICE = KeyCfg(None, None, "", "", 0, parse_flags(""))
+active_device_info = NO_ACTIVE_DEVICE
+
+@lru_cache(maxsize=256)
+def flag_mask(flags_str):
+    f = flags_str or ""
+    return ((FLAG_V if 'V' in f.upper() else 0) | (FLAG_HASH if '#' in f else 0) | (FLAG_N if 'N' in f else 0)
+            | (FLAG_AT if '@' in f else 0) | (FLAG_M if 'M' in f else 0) | (FLAG_OSA if '?' in f else 0))
+
+@lru_cache(maxsize=128)
+def _hex_rgb(bg_hex):
+    """(r, g, b) ints of a '#RRGGBB' string; raises ValueError if it doesn't parse."""
+    return int(bg_hex[1:3], 16), int(bg_hex[3:5], 16), int(bg_hex[5:7], 16)
+
+@lru_cache(maxsize=128)
 def text_color(bg_hex):
     if not bg_hex or len(bg_hex) < 6: return 'white'
-    bg_upper = bg_hex.upper()
-    if bg_upper in [BASE_COLORS.get(c) for c in "YSWLP"]: return 'black'
+    if bg_hex.upper() in BLACK_TEXT_BGS: return 'black'
     try:
-        r, g, b = (int(bg_hex[i:i+2], 16) for i in (1, 3, 5))
+        r, g, b = _hex_rgb(bg_hex)
         lum = 0.299 * r + 0.587 * g + 0.114 * b
         return 'black' if lum > 128 else 'white'
     except:
         return 'white'
 
+@lru_cache(maxsize=64)
 def hex_to_aps_color_values_str(hex_color):
     try: hc = hex_color.lstrip('#'); return f"{{{','.join(str(int(hc[i:i+2],16)*257) for i in (0,2,4))}}}"
     except: return "{0,0,0}"
 
+@lru_cache(maxsize=128)
 def toggle_button_bg(bg_hex):
     try:
-        r,g,b = (min(255,int(bg_hex[i:i+2],16)+70) for i in (1,3,5))
-        if r>250 and g>250 and b>250 and bg_hex.upper()!=BASE_COLORS['W']: r,g,b = (max(0,int(bg_hex[i:i+2],16)-70) for i in (1,3,5))
+        rgb = _hex_rgb(bg_hex); r,g,b = (min(255,c+70) for c in rgb)
+        if r>250 and g>250 and b>250 and bg_hex.upper()!=BASE_COLORS['W']: r,g,b = (max(0,c-70) for c in rgb)
         return f"#{r:02X}{g:02X}{b:02X}"
     except: return BASE_COLORS['W']
 
+@lru_cache(maxsize=128)
 def dim_color(bg_hex):
-    try: return '#000000' if bg_hex.upper()=='#000000' else f"#{''.join(f'{int(bg_hex[i:i+2],16)//2:02X}' for i in (1,3,5))}"
+    try:
+        if bg_hex.upper()=='#000000': return '#000000'
+        r,g,b = _hex_rgb(bg_hex); return f"#{r//2:02X}{g//2:02X}{b//2:02X}"
     except: return bg_hex
 
+@lru_cache(maxsize=512)
 def _transform_ssh_user_for_mobile(command_text):
-    if not command_text or not command_text.lower().strip().startswith("ssh "): return command_text
+    if not command_text or command_text.lstrip()[:4].lower() != "ssh ": return command_text
     match = SSH_USER_HOST_CMD_PATTERN.match(command_text)
     if match:
         ssh_options_part, host_part, remote_cmd_part = match.group(1), match.group(3), match.group(4) or ""
         return f"{ssh_options_part} mobile@{host_part}{remote_cmd_part}"
     return command_text
 
+def ssh_head(command_text):
+    """'ssh <target>' from the start of command_text, or None if it isn't an ssh command."""
+    if command_text[:3] != "ssh" or not command_text[3:4].isspace(): return None
+    target = command_text[4:].split(None, 1)
+    return f"ssh {target[0]}" if target else None
+
 def log_command_to_file(log_path_str, full_command_str):
     try:
         log_dir = Path(log_path_str); log_dir.mkdir(parents=True, exist_ok=True)
         log_file = log_dir / "streamdeck_commander.log"; timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
         with open(log_file, "a", encoding='utf-8') as f: f.write(f"{timestamp} - CMD: {full_command_str}\n")
-        print(f"[INFO] Logged command to '{log_file}'")
+        log.info("Logged command to '%s'", log_file)
     except Exception as e: print(f"[ERROR] Failed to write to log file '{log_path_str}': {e}")
 
+# Recording log lines are buffered and written by a debounced timer so the key callback never blocks on disk I/O.
+_recpath_log_lock = threading.Lock()
+_pending_recpath_logs = []
+_pending_recpath_flush = None
+
 def log_to_recpath(recpath, message_type, content):
-    """Logs a message to log.txt, falling back to the Desktop on permission error."""
+    """Queues a message for log.txt in recpath; the write happens on a background timer."""
+    global _pending_recpath_flush
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+    with _recpath_log_lock:
+        _pending_recpath_logs.append((recpath, timestamp, message_type, content))
+        if _pending_recpath_flush: _pending_recpath_flush.cancel()
+        _pending_recpath_flush = threading.Timer(1.0, flush_recpath_logs); _pending_recpath_flush.daemon = True
+        _pending_recpath_flush.start()
+
+def flush_recpath_logs():
+    """Writes all queued recording log lines, grouped by target directory."""
+    global _pending_recpath_flush
+    with _recpath_log_lock:
+        if _pending_recpath_flush: _pending_recpath_flush.cancel(); _pending_recpath_flush = None
+        pending = _pending_recpath_logs[:]; _pending_recpath_logs.clear()
+    by_path = {}
+    for recpath, timestamp, message_type, content in pending: by_path.setdefault(recpath, []).append((timestamp, message_type, content))
+    for recpath, entries in by_path.items(): _write_recpath_log(recpath, entries)
+
+def _write_recpath_log(recpath, entries):
+    """Appends entries to log.txt, falling back to the Desktop on permission error."""
     try:
         # First attempt: Use the user-provided path
         log_dir = Path(recpath)
         log_dir.mkdir(parents=True, exist_ok=True)
         log_file = log_dir / "log.txt"
-        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
         with open(log_file, "a", encoding='utf-8') as f:
-            f.write(f"[{timestamp}] - {message_type}: {content}\n")
+            f.writelines(f"[{timestamp}] - {message_type}: {content}\n" for timestamp, message_type, content in entries)
     except PermissionError:
         # Fallback on permission error to the Desktop
         fallback_dir = Path.home() / "Desktop"
@@ -371,9 +691,8 @@ def log_to_recpath(recpath, message_type, content):
         try:
             fallback_dir.mkdir(parents=True, exist_ok=True)
             fallback_log_file = fallback_dir / "log.txt"
-            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
             with open(fallback_log_file, "a", encoding='utf-8') as f:
-                f.write(f"[{timestamp}] - {message_type}: {content} (Original path '{recpath}' was not writable)\n")
+                f.writelines(f"[{timestamp}] - {message_type}: {content} (Original path '{recpath}' was not writable)\n" for timestamp, message_type, content in entries)
         except Exception as e_fallback:
             # If even the fallback fails, print a comprehensive error
             print(f"[ERROR] CRITICAL: Failed to write to fallback recording log file: {e_fallback}")
@@ -385,71 +704,186 @@ def send_keystroke_to_terminal(window_title, keystroke):
     script_vars = {"safe_target_title": applescript_escape_string(window_title), "keystroke_content": keystroke}
     try:
         script = load_applescript_template("terminal_keystroke.applescript", **script_vars)
-        subprocess.run(["osascript", "-"], input=script, text=True, check=False)
-        print(f"[INFO] Sent keystroke '{keystroke}' to window '{window_title}'")
+        run_osascript(script)
+        log.info("Sent keystroke '%s' to window '%s'", keystroke, window_title)
     except FileNotFoundError: print("[ERROR] Could not find terminal_keystroke.applescript")
 
+@lru_cache(maxsize=256)
+def _wrap_text(text, width, max_lines, placeholder="…"):
+    """Greedy word wrap matching textwrap.wrap for single-spaced labels, minus hyphen splitting. Returns a tuple."""
+    width = max(1, int(width)); pending = text.split()[::-1]; lines = []
+    while pending:
+        cur, cur_len = [], 0
+        while pending and cur_len + len(pending[-1]) + (1 if cur else 0) <= width:
+            cur_len += len(pending[-1]) + (1 if cur else 0); cur.append(pending.pop())
+        if pending and len(pending[-1]) > width:
+            space = width - cur_len - (1 if cur else 0)
+            if space > 0:
+                word = pending.pop(); pending.append(word[space:])
+                cur_len += space + (1 if cur else 0); cur.append(word[:space])
+        if len(lines) + 1 < max_lines or not pending:
+            lines.append(" ".join(cur)); continue
+        while cur:
+            if cur_len + len(placeholder) <= width: lines.append(" ".join(cur) + placeholder); break
+            cur_len -= len(cur.pop()) + (1 if cur else 0)
+        else:
+            if lines and len(lines[-1]) + len(placeholder) <= width: lines[-1] += placeholder
+            else: lines.append(placeholder)
+        break
+    return tuple(lines)
+
+# Fonts come from the _load_fonts cache, so the font objects themselves are stable cache keys.
+@lru_cache(maxsize=2048)
+def _text_bbox(font, text):
+    """Left-top anchored bbox of text; key labels and status strings repeat across redraws, so each is shaped once."""
+    return font.getbbox(text, anchor="lt") if hasattr(font, 'getbbox') else (0, 0, *font.getsize(text))
+
+@lru_cache(maxsize=32)
+def _label_line_height(font):
+    bbox = _text_bbox(font, "Tg")
+    return bbox[3] - bbox[1] if bbox[3] > bbox[1] else 0
+
+@lru_cache(maxsize=32)
+def _var_line_metrics(font, key_width):
+    """(max chars per variable line, variable line height) for a font at a given key width."""
+    char_w, line_h = font.getsize("M") if hasattr(font, 'getsize') else (6, 10)
+    return (key_width // char_w if char_w > 0 else 12), line_h
+
+@lru_cache(maxsize=4)
+def key_image_size(deck_ref):
+    """Key image (W, H) for a deck; the format is fixed per device, so it is read once."""
+    return tuple(deck_ref.key_image_format()['size'])
+
+# Key images are rendered into a reused scratch buffer (one per thread and key size) instead of
+# allocating a fresh PIL image per key per redraw. to_native_format copies the pixels out.
+_scratch_images = threading.local()
+
+def _get_scratch_image(size, fill):
+    by_size = getattr(_scratch_images, 'by_size', None)
+    if by_size is None: by_size = _scratch_images.by_size = {}
+    if size not in by_size:
+        img = Image.new('RGB', size); by_size[size] = (img, ImageDraw.Draw(img))
+    img, draw = by_size[size]
+    img.paste(fill, (0, 0, *size))
+    return img, draw
+
+@lru_cache(maxsize=64)
+def _load_fonts(*specs):
+    """Returns a tuple of fonts for (path, size) specs; all fall back to the default font if any fails to load."""
+    try: return tuple(ImageFont.truetype(path, size) for path, size in specs)
+    except IOError: return tuple(ImageFont.load_default() for _ in specs)
+
+def warm_font_cache():
+    """Loads the fonts the first page needs, so the first redraw doesn't pay for truetype parsing."""
+    for fs in (DEFAULT_FONT_SIZE, ARROW_FONT_SIZE, 22):
+        _load_fonts((FONT_PATH, 10), (FONT_PATH, fs), (FONT_PATH, 10), (FONT_PATH, 18))
+    _load_fonts((FONT_PATH, DEFAULT_FONT_SIZE), (BOLD_FONT_PATH, 16), (FONT_PATH, 11))
+
+@lru_cache(maxsize=512)
 def render_key(label_text, deck_ref, bg_hex_val, font_size_val, txt_override_color=None, status_text_val=None, vars_text_val=None, flash_active=False, extra_text=None):
-    W,H = deck_ref.key_image_format()['size']; img = PILHelper.create_image(deck_ref); draw = ImageDraw.Draw(img)
+    W,H = key_image_size(deck_ref)
     try: pil_bg = tuple(int(bg_hex_val.lstrip('#')[i:i+2],16) for i in (0,2,4))
     except: pil_bg = (0,0,0)
-    draw.rectangle([(0,0),(W,H)], fill=pil_bg)
-    try:
-        font_status, font_label, font_vars = ImageFont.truetype(FONT_PATH, 10), ImageFont.truetype(FONT_PATH, font_size_val), ImageFont.truetype(FONT_PATH, 10)
-        font_extra = ImageFont.truetype(FONT_PATH, 18) # Font for "SAVE"
-    except IOError: font_status, font_label, font_vars, font_extra = ImageFont.load_default(), ImageFont.load_default(), ImageFont.load_default(), ImageFont.load_default()
+    img, draw = _get_scratch_image((W, H), pil_bg)
+    font_status, font_label, font_vars, font_extra = _load_fonts((FONT_PATH, 10), (FONT_PATH, font_size_val), (FONT_PATH, 10), (FONT_PATH, 18)) # font_extra is for "CONFIG"
     final_text_color = txt_override_color or text_color(bg_hex_val)
     status_text_height_reserved = 0
     actual_status_text_to_draw = status_text_val # Default to showing text
     if status_text_val:
-        s_bbox_temp = font_status.getbbox(status_text_val, anchor="lt") if hasattr(font_status, 'getbbox') else (0,0,*draw.textsize(status_text_val,font=font_status))
+        s_bbox_temp = _text_bbox(font_status, status_text_val)
         status_text_height_reserved = (s_bbox_temp[3] - s_bbox_temp[1]) + LINE_SPACING
         if flash_active:
             actual_status_text_to_draw = ""
             
     if actual_status_text_to_draw:
-        s_bbox = font_status.getbbox(actual_status_text_to_draw,anchor="lt") if hasattr(font_status,'getbbox') else (0,0,*draw.textsize(actual_status_text_to_draw,font=font_status))
+        s_bbox = _text_bbox(font_status, actual_status_text_to_draw)
         draw.text(((W - (s_bbox[2] - s_bbox[0])) / 2, 3), actual_status_text_to_draw, font=font_status, fill=final_text_color, anchor="lt" if hasattr(draw, 'textbbox') else None)
         
     label_y_start = 3 + status_text_height_reserved; current_label_y = label_y_start
     if label_text:
         wrap_width = max(3, min(W // (font_size_val // 1.8 if font_size_val > 10 else 8), 6 if font_size_val >= ARROW_FONT_SIZE else (9 if font_size_val >= DEFAULT_FONT_SIZE else 12)))
-        lines = textwrap.wrap(label_text, width=int(wrap_width), max_lines=3, placeholder="…")
-        lh_bbox = font_label.getbbox("Tg",anchor="lt") if hasattr(font_label,'getbbox') else (0,0,*font_label.getsize("Tg"))
-        line_height_label = lh_bbox[3] - lh_bbox[1] if lh_bbox[3] > lh_bbox[1] else font_size_val
+        lines = _wrap_text(label_text, wrap_width, 3)
+        line_height_label = _label_line_height(font_label) or font_size_val
         total_label_block_height = len(lines) * line_height_label + (len(lines) - 1) * LINE_SPACING if lines else 0
         y_offset = (H - label_y_start - total_label_block_height) / 2 if total_label_block_height < (H - label_y_start) and total_label_block_height > 0 else 0
         current_label_y = label_y_start + y_offset
         for line_item in lines:
             if current_label_y + line_height_label > H : break
-            l_bbox = font_label.getbbox(line_item,anchor="lt") if hasattr(font_label,'getbbox') else (0,0,*draw.textsize(line_item,font=font_label))
+            l_bbox = _text_bbox(font_label, line_item)
             draw.text(((W - (l_bbox[2] - l_bbox[0])) / 2, current_label_y), line_item, font=font_label, fill=final_text_color, anchor="lt" if hasattr(draw, 'textbbox') else None)
             current_label_y += line_height_label + LINE_SPACING
     if vars_text_val:
         var_lines_raw = vars_text_val.split(); var_lines_wrapped_final = []
-        var_char_width_approx = font_vars.getsize("M")[0] if hasattr(font_vars, 'getsize') else 6
-        max_chars_per_var_line_calc = W // var_char_width_approx if var_char_width_approx > 0 else 12
-        for v_item_raw in var_lines_raw: var_lines_wrapped_final.extend(textwrap.wrap(v_item_raw, width=int(max_chars_per_var_line_calc), max_lines=1, placeholder="…"))
-        var_line_height_render = font_vars.getsize("M")[1] if hasattr(font_vars, 'getsize') else 10; num_var_lines_to_draw_final = min(len(var_lines_wrapped_final), 2)
+        max_chars_per_var_line_calc, var_line_height_render = _var_line_metrics(font_vars, W)
+        for v_item_raw in var_lines_raw: var_lines_wrapped_final.extend(_wrap_text(v_item_raw, max_chars_per_var_line_calc, 1))
+        num_var_lines_to_draw_final = min(len(var_lines_wrapped_final), 2)
         start_y_for_vars_block = H - LINE_SPACING - (num_var_lines_to_draw_final * var_line_height_render) - ((num_var_lines_to_draw_final - 1) * VAR_LINE_SPACING if num_var_lines_to_draw_final > 1 else 0)
         actual_y_for_first_var_line = max(start_y_for_vars_block, current_label_y if label_text and lines else label_y_start)
         for i in range(num_var_lines_to_draw_final):
             var_item_to_draw = var_lines_wrapped_final[i]; y_pos_this_var_line = actual_y_for_first_var_line + i * (var_line_height_render + VAR_LINE_SPACING)
             if y_pos_this_var_line + var_line_height_render > H - LINE_SPACING + 2: continue
-            v_bbox = font_vars.getbbox(var_item_to_draw,anchor="lt") if hasattr(font_vars,'getbbox') else (0,0,*draw.textsize(var_item_to_draw,font=font_vars))
+            v_bbox = _text_bbox(font_vars, var_item_to_draw)
             draw.text(((W - (v_bbox[2] - v_bbox[0])) / 2, y_pos_this_var_line ), var_item_to_draw, font=font_vars, fill=final_text_color, anchor="lt" if hasattr(draw, 'textbbox') else None)
     if extra_text:
-        extra_bbox = font_extra.getbbox(extra_text, anchor="lt") if hasattr(font_extra, 'getbbox') else (0,0,*draw.textsize(extra_text,font=font_extra))
+        extra_bbox = _text_bbox(font_extra, extra_text)
         draw.text(((W - (extra_bbox[2] - extra_bbox[0])) / 2, H - (extra_bbox[3] - extra_bbox[1]) - 5), extra_text, font=font_extra, fill=final_text_color, anchor="lt" if hasattr(draw, 'textbbox') else None)
     return PILHelper.to_native_format(deck_ref,img)
 
+@lru_cache(maxsize=128)
+def render_record_key(label_text, deck_ref, bg_hex_val, font_size_val, state, flash_active, take_display):
+    W, H = key_image_size(deck_ref)
+
+    final_bg_hex = bg_hex_val
+    status_text_to_draw = None
+
+    if state == "ERROR":
+        final_bg_hex = BASE_COLORS['R'] if flash_active else dim_color(BASE_COLORS['R'])
+        status_text_to_draw = "ERROR"
+
+    final_text_color = text_color(final_bg_hex)
+
+    try:
+        pil_bg = tuple(int(final_bg_hex.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
+    except:
+        pil_bg = (0, 0, 0)
+    img, draw = _get_scratch_image((W, H), pil_bg)
+
+    if state == "RECORDING" and flash_active:
+        ellipse_fill = tuple(int(BASE_COLORS['R'].lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
+        draw.ellipse([(10, 10), (W - 10, H - 10)], fill=ellipse_fill)
+        final_text_color = text_color(BASE_COLORS['R'])
+
+    font_label, font_take, font_status = _load_fonts((FONT_PATH, font_size_val), (BOLD_FONT_PATH, 16), (FONT_PATH, 11))
+
+    label_y_pos = H * 0.45
+    if status_text_to_draw:
+        label_y_pos = H * 0.55
+        s_bbox = _text_bbox(font_status, status_text_to_draw)
+        draw.text(((W - (s_bbox[2] - s_bbox[0])) / 2, 5), status_text_to_draw, font=font_status, fill=final_text_color)
+
+    wrapped_label = "\n".join(_wrap_text(label_text, 10, 2))
+    draw.text((W / 2, label_y_pos), wrapped_label, font=font_label, fill=final_text_color, anchor="ma", spacing=LINE_SPACING, align="center")
+
+    draw.text((W / 2, H * 0.80), f"TAKE {take_display}", font=font_take, fill=final_text_color, anchor="ma")
+    return PILHelper.to_native_format(deck_ref, img)
+
+TERMINAL_TEMPLATES = {"spawn_ssh_and_snapshot": "terminal_spawn_ssh_and_snapshot.applescript","spawn_and_snapshot": "terminal_spawn_and_snapshot.applescript","n_staged": "terminal_n_for_at_staged_keystroke.applescript","at_n": "terminal_activate_new_styled_at_n.applescript","at_only": "terminal_activate_found_at_only.applescript","n_alone": "terminal_activate_standalone_n.applescript","to_active_at": "terminal_command_to_active_at_device.applescript","default": "terminal_do_script_default.applescript","force_local_new_window": "terminal_force_new_window_and_do_script.applescript"}
+
+@lru_cache(maxsize=128)
+def _terminal_style(lbl, bg_hex, text_color_name):
+    """Escaped window title and AppleScript RGB strings for a styled Terminal window."""
+    return applescript_escape_string(lbl), hex_to_aps_color_values_str(bg_hex), "{65535,65535,65535}" if text_color_name == 'white' else "{0,0,0}"
+
+def _terminal_style_vars(btn_style_cfg, default_lbl, default_bg, title_key='window_custom_title'):
+    title, aps_bg, aps_text = _terminal_style(btn_style_cfg.get('lbl', default_lbl), btn_style_cfg.get('bg_hex', default_bg), btn_style_cfg.get('text_color_name', 'white'))
+    return {title_key: title, 'aps_bg_color': aps_bg, 'aps_text_color': aps_text}
+
 def run_cmd_in_terminal(main_cmd, is_at_act=False, at_has_n=False, btn_style_cfg=None, act_at_lbl=None, is_n_staged=False, ssh_staged="", n_staged="", prepend="", force_new_win_at=False, force_local_execution=False, script_template_override=None, ssh_cmd_to_keystroke=None, actual_cmd_to_keystroke=None):
     eff_cmd = f"{prepend}\n{main_cmd.strip()}" if prepend and main_cmd.strip() else (prepend or main_cmd.strip())
     eff_cmd = eff_cmd.replace('“','"').replace('”','"'); esc_cmd = applescript_escape_string(eff_cmd)
     as_script, script_vars = "", {}
-    tpl_map = {"spawn_ssh_and_snapshot": "terminal_spawn_ssh_and_snapshot.applescript","spawn_and_snapshot": "terminal_spawn_and_snapshot.applescript","n_staged": "terminal_n_for_at_staged_keystroke.applescript","at_n": "terminal_activate_new_styled_at_n.applescript","at_only": "terminal_activate_found_at_only.applescript","n_alone": "terminal_activate_standalone_n.applescript","to_active_at": "terminal_command_to_active_at_device.applescript","default": "terminal_do_script_default.applescript","force_local_new_window": "terminal_force_new_window_and_do_script.applescript"}
     template_key = "default"
-    if script_template_override and script_template_override in tpl_map: template_key = script_template_override
+    if script_template_override and script_template_override in TERMINAL_TEMPLATES: template_key = script_template_override
     elif force_local_execution: template_key = "force_local_new_window"
     elif is_n_staged: template_key = "n_staged"
     elif is_at_act: template_key = "at_n" if at_has_n else "at_only"
@@ -458,36 +892,33 @@ def run_cmd_in_terminal(main_cmd, is_at_act=False, at_has_n=False, btn_style_cfg
     
     if template_key == "n_staged":
         if not btn_style_cfg or not ssh_staged: print(f"[ERR] N-Staged command missing required info (style or ssh command)."); return None
-        script_vars['window_custom_title'] = applescript_escape_string(btn_style_cfg.get('lbl', 'Mobile Session'))
-        script_vars['aps_bg_color'] = hex_to_aps_color_values_str(btn_style_cfg.get('bg_hex', '#0066CC'))
-        script_vars['aps_text_color'] = "{65535,65535,65535}" if btn_style_cfg.get('text_color_name','white')=='white' else "{0,0,0}"
+        script_vars.update(_terminal_style_vars(btn_style_cfg, 'Mobile Session', '#0066CC'))
         script_vars['ssh_command_to_keystroke'] = applescript_escape_string(ssh_staged)
         script_vars['actual_n_command_to_keystroke'] = applescript_escape_string(n_staged)
     elif template_key == "spawn_ssh_and_snapshot":
         if not btn_style_cfg or not ssh_cmd_to_keystroke: return None
-        script_vars = {'window_custom_title': applescript_escape_string(btn_style_cfg.get('lbl', 'Monitor Window')),'aps_bg_color': hex_to_aps_color_values_str(btn_style_cfg.get('bg_hex', '#0066CC')),'aps_text_color': "{65535,65535,65535}" if btn_style_cfg.get('text_color_name', 'white') == 'white' else "{0,0,0}",'ssh_command_to_keystroke': applescript_escape_string(ssh_cmd_to_keystroke or ""),'actual_command_to_keystroke': applescript_escape_string(actual_cmd_to_keystroke or "")}
+        script_vars = {**_terminal_style_vars(btn_style_cfg, 'Monitor Window', '#0066CC'),'ssh_command_to_keystroke': applescript_escape_string(ssh_cmd_to_keystroke or ""),'actual_command_to_keystroke': applescript_escape_string(actual_cmd_to_keystroke or "")}
     elif template_key == "spawn_and_snapshot":
         if not btn_style_cfg: return None
-        script_vars = {'window_custom_title': applescript_escape_string(btn_style_cfg.get('lbl', 'Monitor Window')),'aps_bg_color': hex_to_aps_color_values_str(btn_style_cfg.get('bg_hex', '#0066CC')),'aps_text_color': "{65535,65535,65535}" if btn_style_cfg.get('text_color_name', 'white') == 'white' else "{0,0,0}",'initial_command_to_run': esc_cmd}
+        script_vars = {**_terminal_style_vars(btn_style_cfg, 'Monitor Window', '#0066CC'),'initial_command_to_run': esc_cmd}
     elif template_key in ["at_n", "at_only"]:
         if not btn_style_cfg or 'lbl' not in btn_style_cfg:
             script_vars['final_script_payload_for_do_script'] = esc_cmd; template_key = "default"
         else:
-            dev_lbl = btn_style_cfg['lbl']
-            script_vars.update({'escaped_device_label': applescript_escape_string(dev_lbl),'aps_bg_color': hex_to_aps_color_values_str(btn_style_cfg.get('bg_hex', '#000000')),'aps_text_color': "{65535,65535,65535}" if btn_style_cfg.get('text_color_name', 'white') == 'white' else "{0,0,0}"})
+            script_vars.update(_terminal_style_vars(btn_style_cfg, '', '#000000', title_key='escaped_device_label'))
             if template_key == "at_n": script_vars['final_script_payload'] = esc_cmd
             else: script_vars['final_script_payload_for_do_script'] = esc_cmd; script_vars['force_new_window'] = "true" if force_new_win_at else "false"
     elif template_key in ["force_local_new_window", "n_alone", "default"]:
         script_vars['final_script_payload_for_do_script'] = esc_cmd
         if template_key == "n_alone" and btn_style_cfg:
-             script_vars.update({'window_custom_title': applescript_escape_string(btn_style_cfg.get('lbl', 'N Window')),'aps_bg_color': hex_to_aps_color_values_str(btn_style_cfg.get('bg_hex', '#000000')),'aps_text_color': "{65535,65535,65535}" if btn_style_cfg.get('text_color_name', 'white') == 'white' else "{0,0,0}"})
+             script_vars.update(_terminal_style_vars(btn_style_cfg, 'N Window', '#000000'))
     elif template_key == "to_active_at":
         script_vars = {'safe_target_title': applescript_escape_string(act_at_lbl), 'final_script_payload_for_do_script': esc_cmd, 'main_command_raw_for_emptiness_check': esc_cmd, 'command_to_type_literally_content': esc_cmd}
     
-    if template_key: as_script = load_applescript_template(tpl_map[template_key], **script_vars)
+    if template_key: as_script = load_applescript_template(TERMINAL_TEMPLATES[template_key], **script_vars)
     if as_script:
         try:
-            proc = subprocess.run(["osascript","-"],input=as_script,text=True,capture_output=True,check=False, timeout=15)
+            proc = run_osascript(as_script, timeout=15)
             stderr_lower = proc.stderr.lower().strip() if proc.stderr else ""
             if proc.returncode != 0 and "(-128)" not in stderr_lower and "(-1712)" not in stderr_lower:
                 print(f"[ERROR] AppleScript execution failed (RC:{proc.returncode}).", file=sys.stderr); print(f"  AS STDERR: {proc.stderr.strip()}", file=sys.stderr)
@@ -496,37 +927,87 @@ def run_cmd_in_terminal(main_cmd, is_at_act=False, at_has_n=False, btn_style_cfg
         except Exception as e_as: print(f"[FATAL] Error running osascript: {e_as}", file=sys.stderr)
     return None
 
+def queue_cmd_in_terminal(*args, **kwargs):
+    """Queues run_cmd_in_terminal on the terminal worker and returns its Future; callers that need the output wait on it."""
+    def _report(f):
+        if not f.cancelled() and f.exception(): print(f"[ERROR] Terminal command failed: {f.exception()}", file=sys.stderr)
+    future = _terminal_executor.submit(run_cmd_in_terminal, *args, **kwargs); future.add_done_callback(_report)
+    return future
+
+def with_ssh_mux(ssh_cmd):
+    return f"ssh {SSH_MUX_OPTS} {ssh_cmd[4:]}" if ssh_cmd.startswith("ssh ") else ssh_cmd
+
+# Device keys pointing at the same ssh target share one check per tick: a check started within
+# SSH_CHECK_REUSE_SECS (finished or still running) is reused instead of spawning another ssh.
+_ssh_checks, _ssh_checks_lock = {}, threading.Lock()
+SSH_CHECK_REUSE_SECS = 2.5
+
+def _ssh_check(chk_argv, needs_shell):
+    key = chk_argv if needs_shell else tuple(chk_argv)
+    with _ssh_checks_lock:
+        started, future = _ssh_checks.get(key, (0.0, None))
+        reuse = future is not None and time.monotonic() - started < SSH_CHECK_REUSE_SECS
+        if not reuse: future = Future(); _ssh_checks[key] = (time.monotonic(), future)
+    if reuse: return future.result()
+    ok = False
+    try: ok = subprocess.run(chk_argv, shell=needs_shell, capture_output=True, text=True, timeout=8).returncode == 0
+    except Exception: pass
+    finally: future.set_result(ok)
+    return ok
+
+# A monitor's generation token is a threading.Event: a newer generation or a cancel sets it, so the
+# monitor thread wakes from its sleep and exits immediately instead of after its next poll.
+def new_monitor_generation(global_idx):
+    cancel_monitor(global_idx)
+    generation = monitor_generations[global_idx] = threading.Event()
+    return generation
+
+def cancel_monitor(global_idx):
+    generation = monitor_generations.get(global_idx)
+    if generation is not None: generation.set(); monitor_generations[global_idx] = None
+
+def cancel_all_monitors():
+    for generation in list(monitor_generations.values()):
+        if generation is not None: generation.set()
+    monitor_generations.clear()
+
 def monitor_ssh(global_idx, ssh_cmd_base, generation_id):
-    chk_cmd = f"{ssh_cmd_base} exit"
+    chk_cmd = f"{with_ssh_mux(ssh_cmd_base)} exit"; needs_shell = any(c in chk_cmd for c in "|;&><")
+    try: chk_argv = chk_cmd if needs_shell else shlex.split(chk_cmd)
+    except ValueError: chk_argv = None # Unbalanced quotes: the check can never run, so the key stays BROKEN.
     while global_idx in monitor_threads and monitor_generations.get(global_idx) == generation_id:
         if monitor_generations.get(global_idx) != generation_id: break
-        new_state = 'BROKEN'; time.sleep(3.0 + (global_idx % 5) * 0.1)
+        new_state = 'BROKEN'
+        if generation_id.wait(3.0 + (global_idx % 5) * 0.1): break
         try:
-            res = subprocess.run(shlex.split(chk_cmd) if not any(c in chk_cmd for c in "|;&><") else chk_cmd, shell=any(c in chk_cmd for c in "|;&><"), capture_output=True, text=True, timeout=8)
-            if res.returncode == 0: new_state = 'connected'
+            if chk_argv is not None and _ssh_check(chk_argv, needs_shell): new_state = 'connected'
         except: pass
         if monitor_generations.get(global_idx) == generation_id:
-            if monitor_states.get(global_idx) != new_state: monitor_states[global_idx] = new_state
+            set_monitor_state(global_idx, new_state)
         else: break
 def monitor_remote_process(global_idx, ssh_base_cmd, unique_grep_tag, generation_id):
-    time.sleep(2.0); quoted_tag = shlex.quote(unique_grep_tag)
+    if generation_id.wait(2.0): return
     if monitor_generations.get(global_idx) != generation_id: return
-    grep_cmd_remote = f"ps auxww | grep -F -- {quoted_tag} | grep -v -F -- 'grep -F -- {quoted_tag}'"; full_ssh_cmd_str = f"{ssh_base_cmd} \"{grep_cmd_remote}\""
+    # One remote pgrep, run without a local shell; exec keeps the remote shell (whose command line holds the tag) from matching itself.
+    # pgrep takes an extended regex, so the tag's metacharacters are escaped to keep grep -F's fixed-string match.
+    tag_pattern = ERE_SPECIAL_PATTERN.sub(r"\\\g<0>", unique_grep_tag)
+    try: chk_argv = shlex.split(with_ssh_mux(ssh_base_cmd)) + [f"exec pgrep -f -- {shlex.quote(tag_pattern)}"]
+    except ValueError: set_monitor_state(global_idx, 'PROCESS_ERROR'); return
     while global_idx in monitor_threads and monitor_generations.get(global_idx) == generation_id:
         if monitor_generations.get(global_idx) != generation_id: break
         new_proc_state = 'PROCESS_RUNNING'
         try:
-            result = subprocess.run(full_ssh_cmd_str, shell=True, capture_output=True, text=True, timeout=8)
+            result = subprocess.run(chk_argv, capture_output=True, text=True, timeout=8)
             if result.returncode != 0: new_proc_state = 'PROCESS_BROKEN'
         except: new_proc_state = 'PROCESS_ERROR'
         if monitor_generations.get(global_idx) == generation_id:
             if new_proc_state != 'PROCESS_RUNNING':
                 # Use g_idx directly as the key
                 record_toggle_states[global_idx] = {"state": "ERROR"}
-                monitor_states[global_idx] = new_proc_state
+                set_monitor_state(global_idx, new_proc_state)
                 break
         else: break
-        time.sleep(3.0 + (global_idx % 7) * 0.1)
+        if generation_id.wait(3.0 + (global_idx % 7) * 0.1): break
 
 def monitor_window_snapshot(global_idx, window_id, initial_snapshot, keyword, generation_id):
     snapshot_len = len(initial_snapshot)
@@ -534,7 +1015,7 @@ def monitor_window_snapshot(global_idx, window_id, initial_snapshot, keyword, ge
     def _get_active_context():
         try:
             script_app = 'tell application "System Events" to name of first application process whose frontmost is true'
-            proc_app = subprocess.run(["osascript", "-e", script_app], text=True, capture_output=True, check=False, timeout=1)
+            proc_app = run_osascript(script_app, timeout=1)
             if proc_app.returncode != 0: return None, None
             app_name = proc_app.stdout.strip()
             window_name = get_active_terminal_window_name() if app_name == "Terminal" else None
@@ -546,7 +1027,7 @@ def monitor_window_snapshot(global_idx, window_id, initial_snapshot, keyword, ge
         if not app_name: return
         try:
             script_activate = f'tell application "{applescript_escape_string(app_name)}" to activate'
-            subprocess.run(["osascript", "-e", script_activate], check=False, timeout=1)
+            run_osascript(script_activate, timeout=1)
             if app_name == "Terminal" and window_name:
                 activate_terminal_window(window_name)
         except Exception as e:
@@ -556,13 +1037,13 @@ def monitor_window_snapshot(global_idx, window_id, initial_snapshot, keyword, ge
         if not win_id: return
         try:
             script = f'tell application "Terminal" to set index of (first window whose id is {win_id}) to 1'
-            subprocess.run(["osascript", "-e", script], check=False, timeout=2, capture_output=True)
+            run_osascript(script, timeout=2)
         except Exception as e:
             print(f"[ERROR] Failed to activate monitor window ID '{win_id}': {e}", file=sys.stderr)
 
-    time.sleep(1.0) # Initial delay to allow window to launch fully
+    if generation_id.wait(1.0): return # Initial delay to allow window to launch fully
     while global_idx in monitor_threads and monitor_generations.get(global_idx) == generation_id:
-        time.sleep(60.0)
+        if generation_id.wait(60.0): break
         if monitor_generations.get(global_idx) != generation_id: break
 
         original_app, original_window = (None, None)
@@ -574,14 +1055,14 @@ def monitor_window_snapshot(global_idx, window_id, initial_snapshot, keyword, ge
             _activate_window_by_id(window_id)
             time.sleep(0.2)
             script = load_applescript_template("get_window_content.applescript", window_id=window_id)
-            proc_content = subprocess.run(["osascript", "-"], input=script, text=True, capture_output=True, check=False, timeout=2)
+            proc_content = run_osascript(script, timeout=2)
             current_content = proc_content.stdout.strip()
             if original_app:
                 _restore_context(original_app, original_window)
 
         except Exception as e:
             print(f"[ERROR] Snapshot Monitor context switch/grab failed: {e}")
-            monitor_states[global_idx] = 'OSA_ERROR'; monitor_generations[global_idx] = None
+            cancel_monitor(global_idx); set_monitor_state(global_idx, 'OSA_ERROR')
             break
 
         # Phase 2: Process data (no more UI interaction)
@@ -589,30 +1070,27 @@ def monitor_window_snapshot(global_idx, window_id, initial_snapshot, keyword, ge
         if current_content is None: continue
 
         if current_content == "WINDOW_GONE":
-            monitor_states[global_idx] = 'OSA_GONE'; monitor_generations[global_idx] = None
+            cancel_monitor(global_idx); set_monitor_state(global_idx, 'OSA_GONE')
             break
         
         if len(current_content) > snapshot_len:
             new_text = current_content[snapshot_len:]
             if keyword.lower() in new_text.lower():
-                monitor_states[global_idx] = 'OSA_FOUND'; monitor_generations[global_idx] = None
+                cancel_monitor(global_idx); set_monitor_state(global_idx, 'OSA_FOUND')
                 _activate_window_by_id(window_id) # Bring monitor window forward and leave it
                 break
 
 def db_update_button(button_data):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cur=conn.cursor();cur.execute("UPDATE streamdeck SET label=?,command=?,flags=?,monitor_keyword=? WHERE id=?",(button_data.get('label',''),button_data.get('command',''),button_data.get('flags',''),button_data.get('monitor_keyword',''),button_data['id']));conn.commit();return True
+        with _db_lock: db_conn().execute("UPDATE streamdeck SET label=?,command=?,flags=?,monitor_keyword=? WHERE id=?",(button_data.get('label',''),button_data.get('command',''),button_data.get('flags',''),button_data.get('monitor_keyword',''),button_data['id']));return True
     except sqlite3.Error as e: print(f"[ERROR] DB Update failed: {e}",file=sys.stderr);return False
 def db_add_button(button_data):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cur=conn.cursor();cur.execute("INSERT INTO streamdeck (label,command,flags,monitor_keyword) VALUES (?,?,?,?)",(button_data.get('label',''),button_data.get('command',''),button_data.get('flags',''),button_data.get('monitor_keyword','')));conn.commit();return cur.lastrowid
+        with _db_lock: return db_conn().execute("INSERT INTO streamdeck (label,command,flags,monitor_keyword) VALUES (?,?,?,?)",(button_data.get('label',''),button_data.get('command',''),button_data.get('flags',''),button_data.get('monitor_keyword',''))).lastrowid
     except sqlite3.Error as e: print(f"[ERROR] DB Insert failed: {e}",file=sys.stderr);return None
 def db_delete_button(button_id):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cur=conn.cursor();cur.execute("DELETE FROM streamdeck WHERE id=?",(button_id,));conn.commit();return cur.rowcount>0
+        with _db_lock: return db_conn().execute("DELETE FROM streamdeck WHERE id=?",(button_id,)).rowcount>0
     except sqlite3.Error as e: print(f"[ERROR] DB Delete failed: {e}",file=sys.stderr);return False
 
 # --- FLASK API SERVER ---
@@ -622,21 +1100,23 @@ def get_all_buttons_api():global items,current_session_vars;return jsonify({"but
 @api_app.route('/api/buttons/<int:button_id>',methods=['PUT'])
 def update_button_config_api(button_id):
     global items,page_index,current_session_vars;data=request.json;updated_data={"id":button_id,**data}
-    if not db_update_button(updated_data): return jsonify({"error":"DB update failed"}),500
     item_index=next((i for i,item in enumerate(items) if item['id']==button_id),None)
-    if item_index is not None:items[item_index]=updated_data;initialize_session_vars_from_items(items,current_session_vars);build_page(page_index);
+    # Re-saving an unchanged button from the web UI skips the DB write and page rebuild.
+    if item_index is not None and items[item_index]==updated_data: return jsonify({"message":"Button unchanged","button":updated_data})
+    if not db_update_button(updated_data): return jsonify({"error":"DB update failed"}),500
+    if item_index is not None:items[item_index]=updated_data;_merge_vars_from_item(updated_data,current_session_vars);request_page_rebuild()
     return jsonify({"message":"Button updated","button":updated_data})
 @api_app.route('/api/buttons',methods=['POST'])
 def add_new_button_api():
     global items,page_index,current_session_vars;data=request.json;new_id=db_add_button(data)
     if new_id is None:return jsonify({"error":"DB add failed"}),500
-    new_button={"id":new_id,**data};items.append(new_button);initialize_session_vars_from_items(items,current_session_vars);build_page(page_index);
+    new_button={"id":new_id,**data};items.append(new_button);_merge_vars_from_item(new_button,current_session_vars);request_page_rebuild()
     return jsonify({"message":"Button added","button":new_button}),201
 @api_app.route('/api/buttons/<int:button_id>',methods=['DELETE'])
 def delete_button_config_api(button_id):
     global items,page_index,current_session_vars
     if not db_delete_button(button_id):return jsonify({"error":"DB delete failed"}),500
-    items=[i for i in items if i['id']!=button_id];initialize_session_vars_from_items(items,current_session_vars);build_page(page_index);
+    items=[i for i in items if i['id']!=button_id];initialize_session_vars_from_items(items,current_session_vars);request_page_rebuild()
     return jsonify({"message":"Button deleted"})
 @api_app.route('/api/variables', methods=['PUT'])
 def update_session_variables_api():
@@ -644,20 +1124,51 @@ def update_session_variables_api():
     data = request.json
     if isinstance(data, dict):
         current_session_vars.update(data)
-        build_page(page_index) # Trigger a redraw
+        request_page_rebuild()
         return jsonify({"message": "Session variables updated successfully"})
     return jsonify({"error": "Invalid data format, expected a JSON object"}), 400
 
+def request_page_rebuild():
+    global page_rebuild_due
+    if page_rebuild_due is None: page_rebuild_due = time.monotonic() + API_REBUILD_DEBOUNCE # let the rest of a bulk edit land first
+    ui_wake.set()
+
+def rebuild_page_if_pending():
+    """Called from the main loop; never blocks it. If a key handler holds state_lock, retries after another debounce."""
+    global page_rebuild_due
+    if page_rebuild_due is None or time.monotonic() < page_rebuild_due: return
+    if not state_lock.acquire(blocking=False): page_rebuild_due = time.monotonic() + API_REBUILD_DEBOUNCE; return
+    try: page_rebuild_due = None; build_page(page_index)
+    finally: state_lock.release()
+
 def run_flask_app_thread():
     print(f"[INFO] Flask API server starting on http://localhost:{CONFIG_SERVER_PORT}")
-    try: api_app.run(host='127.0.0.1',port=CONFIG_SERVER_PORT,debug=False,use_reloader=False)
+    try:
+        if waitress_serve: waitress_serve(api_app,host='127.0.0.1',port=CONFIG_SERVER_PORT,threads=4,ident=None)
+        else: api_app.run(host='127.0.0.1',port=CONFIG_SERVER_PORT,debug=False,use_reloader=False,threaded=True)
     except Exception as e: print(f"[FATAL] Flask server failed to start: {e}",file=sys.stderr)
 
+def set_active_device(key):
+    global active_device_key, active_device_info
+    active_device_key = key
+    active_device_info = key_cfg[key] if key is not None and key < len(key_cfg) else NO_ACTIVE_DEVICE
+
+# (items snapshot, [(g_idx, item, 'T' sticky, '?' flag)]). Items are replaced, never edited in place,
+# so an identity check against the snapshot tells whether the flag-derived split is still valid.
+_item_layout_cache = ([], [])
+def _static_item_layout():
+    global _item_layout_cache
+    snapshot, layout = _item_layout_cache
+    if len(snapshot) != len(items) or any(a is not b for a, b in zip(snapshot, items)):
+        layout = [(i, item, parse_flags(item['flags'])[2], bool(flag_mask(item.get('flags', '')) & FLAG_OSA)) for i, item in enumerate(items)]
+        _item_layout_cache = (list(items), layout)
+    return layout
+
 def build_page(idx_param):
-    global labels, cmds, flags, items, page_index, key_to_global_item_idx_map, global_item_idx_to_key_map, cnt, load_key_idx, up_key_idx, down_key_idx
+    global labels, cmds, flags, key_cfg, var_users, items, page_index, global_item_idx_to_key_map, cnt, load_key_idx, up_key_idx, down_key_idx
 
     # Create new layout dictionaries that will atomically replace the global ones
-    new_labels, new_cmds, new_flags = {}, {}, {}
+    new_labels, new_cmds, new_flags = [""] * cnt, [""] * cnt, [""] * cnt
     new_key_to_g_idx, new_g_idx_to_key = {}, {}
     page_index = 0 if not items else idx_param
 
@@ -665,10 +1176,8 @@ def build_page(idx_param):
     layout_sticky_items, inplace_sticky_items, normal_items = [], [], []
     state_sticky_indices = {g_idx for g_idx, state_info in record_toggle_states.items() if state_info.get('state') in ['RECORDING', 'ERROR']}
 
-    for i, item in enumerate(items):
-        flags_tuple = parse_flags(item['flags'])
-        mon_state = monitor_states.get(i)
-        is_layout_sticky = flags_tuple[2] or (mon_state == 'OSA_FOUND' and '?' in item.get('flags', ''))
+    for i, item, flag_sticky, osa_flag in _static_item_layout():
+        is_layout_sticky = flag_sticky or (osa_flag and monitor_states.get(i) == 'OSA_FOUND')
         is_inplace_sticky = i in state_sticky_indices
 
         if is_inplace_sticky:
@@ -723,27 +1232,118 @@ def build_page(idx_param):
 
     # 5. Atomically update the global layout state
     labels, cmds, flags = new_labels, new_cmds, new_flags
-    key_to_global_item_idx_map = new_key_to_g_idx
+    key_cfg = [KeyCfg(new_key_to_g_idx.get(k), new_labels[k], new_cmds[k], f, flag_mask(f), parse_flags(f)) for k, f in enumerate(new_flags)]
+    new_var_users = {}
+    for k, cfg in enumerate(key_cfg):
+        if cfg.mask & FLAG_V:
+            for v in cmd_var_names(cfg.cmd): new_var_users.setdefault(v, set()).add(k)
+        if cfg.parsed[8]: new_var_users.setdefault('TAKE', set()).add(k)
+    var_users = new_var_users
+    set_active_device(active_device_key)
     global_item_idx_to_key_map = new_g_idx_to_key
 
     if deck: redraw()
 
+def needs_animation():
+    """True while any key flashes or a background process needs reaping."""
+    if background_processes or (numeric_mode and long_press_numeric_active): return True
+    # list() snapshots in one C call; key handlers and workers resize the dict while the main loop reads it.
+    if any(s.get('state') in ('RECORDING', 'ERROR') for s in list(record_toggle_states.values())): return True
+    return bool(flashing_monitors)
+
+def flashing_keys():
+    """Keys whose image depends on flash_state; only these are repainted on a flash tick."""
+    g_idxs = set(flashing_monitors)
+    # Snapshots (one C call each): key handlers, workers and reload change these while the main loop reads them.
+    g_idxs.update(g for g, s in list(record_toggle_states.items()) if s.get('state') in ('RECORDING', 'ERROR'))
+    g_idxs.update(list(background_processes))
+    key_map = dict(global_item_idx_to_key_map)
+    keys = {key_map[g] for g in g_idxs if g in key_map}
+    if numeric_mode and long_press_numeric_active and numeric_var: keys.update((numeric_var['key'], up_key_idx, down_key_idx))
+    return keys
+
+def set_monitor_state(global_idx, state):
+    """Single entry point for monitor state changes (None clears); queues the key showing global_idx for repaint."""
+    if monitor_states.get(global_idx) == state: return
+    if state is None: monitor_states.pop(global_idx, None)
+    else: monitor_states[global_idx] = state
+    if state in FLASHING_MONITOR_STATES: flashing_monitors.add(global_idx)
+    else: flashing_monitors.discard(global_idx)
+    request_redraw(global_idx)
+
+def request_redraw(global_idx):
+    """Called from monitor threads: marks the key showing global_idx dirty and wakes the main loop."""
+    mark_dirty(global_item_idx_to_key_map.get(global_idx)); ui_wake.set()
+
+def mark_dirty(*keys): dirty_keys.update(k for k in keys if k is not None)
+
+def redraw_vars(var_names, *keys):
+    """Queues only the given keys plus those showing any of var_names for the main loop to repaint."""
+    mark_dirty(*keys)
+    for v in var_names: mark_dirty(*var_users.get(v, ()))
+    ui_wake.set()
+
+def redraw_dirty():
+    if not dirty_keys: return
+    t0 = time.perf_counter_ns()
+    while dirty_keys:
+        try: i_key = dirty_keys.pop()
+        except KeyError: break # Emptied by another thread since the check
+        try: render_individual_key(i_key)
+        except Exception as e: log.warning("Key %s render failed: %s", i_key, e)
+        prof_stats["renders"] += 1
+    prof_stats["render_ns"] += time.perf_counter_ns() - t0
+
+def dump_prof_stats(*_):
+    print("[PROF] " + " ".join(f"{k[:-3]}={v/1e6:.1f}ms" if k.endswith("_ns") else f"{k}={v}" for k, v in prof_stats.items()), file=sys.stderr)
+    for k in prof_stats: prof_stats[k] = 0
+
+def set_key_image_if_changed(i_key, image):
+    if last_key_images.get(i_key) == image: return
+    if _key_image_writer is None: deck.set_key_image(i_key, image); last_key_images[i_key] = image; return
+    last_key_images[i_key] = image # The writer drops this entry again if the USB write fails
+    with _pending_images_lock: _pending_images[i_key] = image
+    _pending_images_ready.set()
+
+def _key_image_writer_loop():
+    # Only the newest image per key is kept, so a burst of repaints costs one USB write per key.
+    while True:
+        _pending_images_ready.wait(); _pending_images_ready.clear()
+        with _pending_images_lock: batch = dict(_pending_images); _pending_images.clear()
+        if stop_event.is_set(): return
+        if not batch: continue
+        t0 = time.perf_counter_ns()
+        with deck:
+            for i_key, image in batch.items():
+                try: deck.set_key_image(i_key, image)
+                except Exception as e:
+                    log.warning("Key %s image write failed: %s", i_key, e)
+                    if last_key_images.get(i_key) is image: del last_key_images[i_key] # So the next repaint re-sends it
+        prof_stats["usb_ns"] += time.perf_counter_ns() - t0; prof_stats["usb_writes"] += len(batch)
+
+def start_key_image_writer():
+    global _key_image_writer
+    _key_image_writer = threading.Thread(target=_key_image_writer_loop, name="sd-images", daemon=True); _key_image_writer.start()
+
+def stop_key_image_writer():
+    if _key_image_writer is None: return
+    stop_event.set(); _pending_images_ready.set(); _key_image_writer.join(timeout=1)
+
 def redraw():
+    """Queues every key for repaint; the main loop renders them, so key callbacks and API threads never rasterize."""
     if not deck: return
-    for i_key in range(deck.key_count()): render_individual_key(i_key)
+    mark_dirty(*range(cnt)); ui_wake.set()
 
 def render_individual_key(i_key):
-    global deck, key_to_global_item_idx_map, items, monitor_states, record_toggle_states, active_device_key, numeric_mode, long_press_numeric_active, numeric_var, flash_state, current_session_vars, up_key_idx, down_key_idx, labels, flags, cmds, load_key_idx
+    global deck, items, monitor_states, record_toggle_states, active_device_key, numeric_mode, long_press_numeric_active, numeric_var, flash_state, current_session_vars, up_key_idx, down_key_idx, labels, flags, cmds, load_key_idx
     if not deck: return
 
-    lbl_render, cmd_render, f_str_render = labels.get(i_key, ""), cmds.get(i_key, ""), flags.get(i_key, "")
-    g_idx = key_to_global_item_idx_map.get(i_key)
-    
-    if g_idx is not None and g_idx < len(items):
-        item = items[g_idx]
-        lbl_render, cmd_render, f_str_render = item.get('label',''), item.get('command',''), item.get('flags','')
-    
-    _, dev_flag, _, bg_color, fs, _, is_mobile, osa_mon_flag, record_flag, background_flag, confirm_flag, monitor_flag = parse_flags(f_str_render)
+    # key_cfg is rebuilt by build_page whenever items change, so its item index and parsed style are current.
+    cfg = key_cfg[i_key] if i_key < len(key_cfg) else KeyCfg(None, "", "", "", 0, parse_flags(""))
+    g_idx = cfg.g_idx
+    lbl_render, cmd_render = cfg.label, cfg.cmd
+
+    _, dev_flag, _, bg_color, fs, _, is_mobile, osa_mon_flag, record_flag, background_flag, confirm_flag, monitor_flag = cfg.parsed
     status_render, vars_render, extra_txt = None, None, None
     bg_render, txt_override_render = bg_color, None
     should_flash_status_text = False
@@ -755,55 +1355,13 @@ def render_individual_key(i_key):
         state_info = record_toggle_states.get(g_idx, {"state": "OFF"})
         state = state_info.get("state", "OFF")
         
-        W, H = deck.key_image_format()['size']
-        img = PILHelper.create_image(deck)
-        draw = ImageDraw.Draw(img)
-        
-        final_bg_hex = bg_color
-        status_text_to_draw = None
-
-        if state == "ERROR":
-            final_bg_hex = BASE_COLORS['R'] if flash_state else dim_color(BASE_COLORS['R'])
-            status_text_to_draw = "ERROR"
-        
-        final_text_color = text_color(final_bg_hex)
-        
-        try:
-            pil_bg = tuple(int(final_bg_hex.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
-        except:
-            pil_bg = (0, 0, 0)
-        draw.rectangle([(0, 0), (W, H)], fill=pil_bg)
-
-        if state == "RECORDING" and flash_state:
-            ellipse_fill = tuple(int(BASE_COLORS['R'].lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
-            draw.ellipse([(10, 10), (W - 10, H - 10)], fill=ellipse_fill)
-            final_text_color = text_color(BASE_COLORS['R'])
-        
-        try:
-            font_label = ImageFont.truetype(FONT_PATH, fs)
-            font_take = ImageFont.truetype(BOLD_FONT_PATH, 16)
-            font_status = ImageFont.truetype(FONT_PATH, 11)
-        except IOError:
-            font_label, font_take, font_status = ImageFont.load_default(), ImageFont.load_default(), ImageFont.load_default()
-
-        label_y_pos = H * 0.45
-        if status_text_to_draw:
-            label_y_pos = H * 0.55
-            s_bbox = font_status.getbbox(status_text_to_draw, anchor="lt") if hasattr(font_status, 'getbbox') else (0, 0, *draw.textsize(status_text_to_draw, font=font_status))
-            draw.text(((W - (s_bbox[2] - s_bbox[0])) / 2, 5), status_text_to_draw, font=font_status, fill=final_text_color)
-
-        wrapped_label = "\n".join(textwrap.wrap(lbl_render, width=10, max_lines=2, placeholder="…"))
-        draw.text((W / 2, label_y_pos), wrapped_label, font=font_label, fill=final_text_color, anchor="ma", spacing=LINE_SPACING, align="center")
-
         take_val_str = current_session_vars.get("TAKE", "1")
         try:
             take_val_display = str(int(take_val_str)).zfill(3)
         except (ValueError, TypeError):
             take_val_display = take_val_str[:3] # Show first 3 chars if not a number
 
-        draw.text((W / 2, H * 0.80), f"TAKE {take_val_display}", font=font_take, fill=final_text_color, anchor="ma")
-        
-        deck.set_key_image(i_key, PILHelper.to_native_format(deck, img))
+        set_key_image_if_changed(i_key, render_record_key(lbl_render, deck, bg_color, fs, state, flash_state and state in ("RECORDING", "ERROR"), take_val_display))
         return
 
     # --- Generic Rendering for all other buttons ---
@@ -843,31 +1401,34 @@ def render_individual_key(i_key):
         else: # Process finished or was killed
             del background_processes[g_idx] # Clean up
             
-    if 'V' in f_str_render:
-        vars_to_display = []
-        for match in VAR_PATTERN.finditer(cmd_render):
-            var_name = match.group(1).strip()
-            if var_name in current_session_vars: vars_to_display.append(str(current_session_vars[var_name]))
+    if cfg.mask & FLAG_V:
+        vars_to_display = [current_session_vars[v] for v in cmd_var_names(cmd_render) if v in current_session_vars]
         if vars_to_display: vars_render = " ".join(vars_to_display)
 
     if numeric_mode and long_press_numeric_active:
         num_key = numeric_var['key']
-        if i_key == num_key or i_key in [up_key_idx, down_key_idx]:
-            _,_,_,num_orig_bg,_,_,_,_,_,_,_,_ = parse_flags(flags.get(num_key,""));bright_num_bg=toggle_button_bg(num_orig_bg)
-            bg_render=bright_num_bg if flash_state else(num_orig_bg if i_key==num_key else dim_color(bright_num_bg));txt_override_render=text_color(bg_render)
-            if i_key == num_key: vars_render = str(current_session_vars.get(numeric_var['name'],""))
-            elif i_key in [up_key_idx,down_key_idx]:
-                op,step=("+",numeric_var.get('step',1.0)) if i_key==up_key_idx else ("-",numeric_var.get('step',1.0)); (status_render,vars_render) = (f"{op}{step}",None) if i_key==down_key_idx else (None,f"{op}{step}")
+        nav_keys = (num_key, up_key_idx, down_key_idx)
+        if i_key in nav_keys:
+            # role 0 shows the value, 1 (up) and 2 (down) show the signed step.
+            role = nav_keys.index(i_key)
+            num_orig_bg = key_cfg[num_key].parsed[3]; bright_num_bg = toggle_button_bg(num_orig_bg)
+            bg_render = bright_num_bg if flash_state else num_orig_bg if role == 0 else dim_color(bright_num_bg)
+            txt_override_render = text_color(bg_render)
+            if role == 0: vars_render = current_session_vars.get(numeric_var['name'], "")
+            else:
+                step_txt = f"{'+-'[role-1]}{numeric_var.get('step',1.0)}"
+                status_render, vars_render = (None, step_txt) if role == 1 else (step_txt, None)
 
     if i_key == load_key_idx:
         final_fs = 22
-    elif i_key in [up_key_idx, down_key_idx]:
+        if db_reloading: status_render = "RELOAD..."
+    elif i_key in (up_key_idx, down_key_idx):
         final_fs = ARROW_FONT_SIZE
     else:
         final_fs = fs
         
     try:
-        deck.set_key_image(i_key, render_key(lbl_render, deck, bg_render, final_fs, txt_override_render, status_render, vars_render, flash_active=(should_flash_status_text and flash_state), extra_text=extra_txt))
+        set_key_image_if_changed(i_key, render_key(lbl_render, deck, bg_render, final_fs, txt_override_render, status_render, vars_render, flash_active=(should_flash_status_text and flash_state), extra_text=extra_txt))
     except Exception as e:
         print(f"[ERROR] Render key {i_key} failed: {e}", file=sys.stderr)
         import traceback
@@ -878,57 +1439,177 @@ def render_individual_key(i_key):
 def start_monitoring():
     global items, monitor_threads, monitor_states, current_session_vars, monitor_generations
     for g_idx in list(monitor_threads.keys()):
-        monitor_generations[g_idx] = None; monitor_threads.pop(g_idx, None)
+        cancel_monitor(g_idx); monitor_threads.pop(g_idx, None)
     for g_idx, item_data in enumerate(items):
         item_cmd_mon, item_flags_mon = item_data.get('command',''), item_data.get('flags','')
         # --- MODIFIED: Use new parse_flags tuple ---
         _, _, _, _, _, _, _, _, _, _, _, monitor_flag = parse_flags(item_flags_mon)
-        if monitor_flag and '@' in item_flags_mon:
-            monitor_states[g_idx] = 'initializing'
-            current_gen_id = time.time(); monitor_generations[g_idx] = current_gen_id
+        fm_mon = flag_mask(item_flags_mon)
+        if monitor_flag and fm_mon & FLAG_AT:
+            set_monitor_state(g_idx, 'initializing')
+            current_gen_id = new_monitor_generation(g_idx)
             resolved_cmd_mon = resolve_command_string(item_cmd_mon, current_session_vars)
-            if 'M' in item_flags_mon and resolved_cmd_mon.lower().strip().startswith("ssh "): resolved_cmd_mon = _transform_ssh_user_for_mobile(resolved_cmd_mon)
-            ssh_match_mon = re.match(r"^(ssh\s+[^ ]+)", resolved_cmd_mon)
-            if ssh_match_mon:
-                thread = threading.Thread(target=monitor_ssh, args=(g_idx, ssh_match_mon.group(1), current_gen_id), daemon=True)
+            if fm_mon & FLAG_M: resolved_cmd_mon = _transform_ssh_user_for_mobile(resolved_cmd_mon)
+            ssh_target_mon = ssh_head(resolved_cmd_mon)
+            if ssh_target_mon:
+                thread = threading.Thread(target=monitor_ssh, args=(g_idx, ssh_target_mon, current_gen_id), daemon=True)
                 monitor_threads[g_idx] = thread; thread.start()
-            else: monitor_states[g_idx] = 'error_config'
+            else: set_monitor_state(g_idx, 'error_config')
     print("[INFO] Monitoring initialized.")
 
-def load_data_and_reinit_vars():
-    global items, current_session_vars, page_index, numeric_mode, numeric_var, active_device_key, toggle_keys, long_press_numeric_active, at_devices_to_reinit_cmd, flash_state, key_to_global_item_idx_map, global_item_idx_to_key_map, monitor_generations, record_toggle_states
-    print("[INFO] Rebuilding database from Numbers & reloading configs...")
+def db_has_streamdeck_table():
+    """True if DB_PATH already holds the streamdeck table, so startup can skip the Numbers rebuild."""
+    if not DB_PATH.exists(): return False
     try:
-        # NOTE: This now calls your robust database script (renamed to streamdeck_db.py)
-        py_exec = sys.executable; load_script_path = APP_DIR/"streamdeck_db.py"
-        if not load_script_path.exists(): load_script_path = Path("streamdeck_db.py")
-        subprocess.run([py_exec,str(load_script_path),str(DB_PATH)],check=True,capture_output=True,text=True)
-    except Exception as e:
-        err_out = getattr(e, 'stderr', '') or getattr(e, 'stdout', '') or str(e)
-        print(f"[FATAL] DB Load Script failed: {err_out}. Exiting.", file=sys.stderr)
-        if deck: deck.close(); sys.exit(1)
-    items[:] = get_items()
-    initialize_session_vars_from_items(items, current_session_vars)
-    page_index=0; numeric_mode=False; numeric_var=None; long_press_numeric_active=False
-    active_device_key=None; toggle_keys.clear(); at_devices_to_reinit_cmd.clear()
-    flash_state=False; key_to_global_item_idx_map.clear(); global_item_idx_to_key_map.clear(); monitor_generations.clear(); record_toggle_states.clear()
-    if not items: print("[WARNING] No items from DB.")
-    if deck: build_page(page_index); start_monitoring()
+        with _db_lock: return db_conn().execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='streamdeck'").fetchone() is not None
+    except sqlite3.Error: return False
+
+def rebuild_database():
+    """Runs the Numbers -> SQLite loader, streaming its output to the log. Raises CalledProcessError on failure."""
+    load_script_path = LOAD_SCRIPT if LOAD_SCRIPT.exists() else Path("streamdeck_db.py")
+    close_db()
+    proc = subprocess.Popen([sys.executable,str(load_script_path),str(DB_PATH)],stdout=subprocess.PIPE,stderr=subprocess.STDOUT,text=True,bufsize=1)
+    tail = []
+    for line in proc.stdout:
+        log.info("db: %s", line.rstrip()); tail = (tail + [line])[-20:]
+    close_db() # Anything that reconnected mid-rebuild may hold the deleted file.
+    if proc.wait() != 0: raise subprocess.CalledProcessError(proc.returncode, proc.args, output="".join(tail))
+
+def load_data_and_reinit_vars(rebuild_db=True):
+    if rebuild_db:
+        print("[INFO] Rebuilding database from Numbers & reloading configs...")
+        try: rebuild_database()
+        except Exception as e:
+            err_out = getattr(e, 'output', '') or str(e)
+            print(f"[FATAL] DB Load Script failed: {err_out}. Exiting.", file=sys.stderr)
+            if deck: deck.close(); sys.exit(1)
+    else: print("[INFO] Reloading configs from existing database...")
+    reinit_from_database()
+
+def reinit_from_database():
+    global items, current_session_vars, page_index, numeric_mode, numeric_var, active_device_key, toggle_keys, long_press_numeric_active, at_devices_to_reinit_cmd, flash_state, global_item_idx_to_key_map, monitor_generations, record_toggle_states
+    with state_lock:
+        items[:] = get_items()
+        initialize_session_vars_from_items(items, current_session_vars)
+        page_index=0; numeric_mode=False; numeric_var=None; long_press_numeric_active=False
+        set_active_device(None); toggle_keys.clear(); at_devices_to_reinit_cmd.clear()
+        flash_state=False; global_item_idx_to_key_map.clear(); cancel_all_monitors(); record_toggle_states.clear()
+        for g in list(monitor_states): set_monitor_state(g, None) # Stale states would flash forever or attach to the new item at that g_idx
+        if not items: print("[WARNING] No items from DB.")
+        if deck: build_page(page_index); start_monitoring()
+
+def reload_in_background():
+    """LOAD key: rebuilds the DB on a worker thread so the deck stays responsive; the LOAD key shows RELOAD... meanwhile."""
+    global db_reloading
+    if db_reloading: return
+    db_reloading = True; mark_dirty(load_key_idx); ui_wake.set()
+    def _run():
+        global db_reloading
+        try:
+            print("[INFO] Rebuilding database from Numbers & reloading configs...")
+            try: rebuild_database()
+            except Exception as e:
+                print(f"[FATAL] DB Load Script failed: {getattr(e, 'output', '') or e}. Exiting.", file=sys.stderr)
+                stop_event.set(); ui_wake.set(); return
+            reinit_from_database()
+        finally:
+            with state_lock: db_reloading = False; mark_dirty(load_key_idx); ui_wake.set()
+    threading.Thread(target=_run, name="sd-reload", daemon=True).start()
+
+def run_dialog_flow(flow_fn, *args):
+    """Runs a blocking dialog sequence on the dialog worker so the deck callback returns immediately."""
+    def _run():
+        try: flow_fn(*args)
+        except Exception as e: print(f"[ERROR] Dialog flow failed: {e}", file=sys.stderr)
+    _dialog_executor.submit(_run)
+
+def _edit_record_vars_flow(orig_item_cmd_from_db):
+    changed = set()
+    original_scene_value = current_session_vars.get('SCENE', '')
+
+    variables_to_edit = [(raw_name.strip(), default if default is not None else "") for raw_name, default in cmd_var_specs(orig_item_cmd_from_db) if raw_name.upper() != 'TAKE']
+    current_vals = [current_session_vars.get(var_name, default_val) for var_name, default_val in variables_to_edit]
+    answers = execute_applescript_multi_dialog([(f"Enter value for {var_name}:", current_val) for (var_name, _), current_val in zip(variables_to_edit, current_vals)], stop_on_cancel=True)
+    for (var_name, _), current_val, user_input in zip(variables_to_edit, current_vals, answers):
+        if user_input is None:
+            with state_lock: redraw_vars(changed)
+            return
+        if user_input != current_val:
+            with state_lock: current_session_vars[var_name] = user_input
+            changed.add(var_name)
+
+    new_scene_value = current_session_vars.get('SCENE', '')
+    scene_changed = original_scene_value != new_scene_value
+
+    take_match = TAKE_DEFAULT_PATTERN.search(orig_item_cmd_from_db)
+    default_take_str = "1"
+    if take_match and take_match.group(1).isdigit():
+        default_take_str = take_match.group(1)
+
+    suggested_take = default_take_str if scene_changed else current_session_vars.get('TAKE', default_take_str)
+    prompt_message_take = f"SCENE changed. Reset TAKE or enter new value:" if scene_changed else "Enter TAKE number:"
+
+    user_input_take = execute_applescript_dialog(prompt_message_take, suggested_take)
+    with state_lock:
+        if user_input_take:
+            current_session_vars['TAKE'] = user_input_take; changed.add('TAKE')
+        redraw_vars(changed)
+
+def _edit_button_vars_flow(k_idx, cfg, is_device):
+    changed=set()
+    specs=[(raw_name.strip(),default or"") for raw_name,default in cmd_var_specs(cfg.cmd)]
+    current_vals=[current_session_vars.get(v_n,d_v) for v_n,d_v in specs]
+    answers=execute_applescript_multi_dialog([(f"Val for {v_n}:",c_v) for (v_n,_),c_v in zip(specs,current_vals)])
+    for (v_n,_),c_v,n_v in zip(specs,current_vals,answers):
+        if n_v and n_v!=c_v:
+            with state_lock: current_session_vars[v_n]=n_v;changed.add(v_n)
+    with state_lock:
+        # The key may show another button by now (page flip, reload); only its variables still apply.
+        if is_device and k_idx < len(key_cfg) and key_cfg[k_idx] == cfg:
+            at_devices_to_reinit_cmd.add(k_idx)
+            if k_idx==active_device_key and changed:set_active_device(None);toggle_keys.discard(k_idx)
+        redraw_vars(changed, k_idx)
+
+def open_config_ui():
+    """Starts the web UI dev server if needed and opens it; blocks for the server start-up, so runs on its own thread."""
+    global web_ui_process
+    if web_ui_process is None or web_ui_process.poll() is not None:
+        if not WEB_UI_DIR.exists() or not(WEB_UI_DIR/"package.json").exists():return
+        try:web_ui_process=subprocess.Popen(['npm','run','dev'],cwd=WEB_UI_DIR,stdout=subprocess.PIPE,stderr=subprocess.PIPE,text=True);time.sleep(5)
+        except Exception as e:print(f"[ERROR] Failed to start Web UI server: {e}",file=sys.stderr);return
+    webbrowser.open(f"http://localhost:{REACT_APP_DEV_PORT}")
+
+def turn_page(delta):
+    global page_index
+    page_index += delta; build_page(page_index)
+
+def build_control_key_actions():
+    """(key, long_press) -> action for the fixed LOAD/▲/▼ keys; combinations not listed do nothing."""
+    return {
+        (load_key_idx, False): reload_in_background,
+        (load_key_idx, True): lambda: load_data_and_reinit_vars(rebuild_db=False), # Re-reads the DB without re-fetching from Numbers
+        (up_key_idx, False): lambda: turn_page(-1),
+        (down_key_idx, False): lambda: turn_page(1),
+        (down_key_idx, True): lambda: threading.Thread(target=open_config_ui, name="sd-config-ui", daemon=True).start(), # npm start-up waits 5 s
+    }
 
 def callback(deck_param, k_idx, pressed):
-    global page_index, numeric_mode, numeric_var, active_device_key, labels, cmds, flags, items, toggle_keys, current_session_vars, press_times, long_press_numeric_active, up_key_idx, down_key_idx, load_key_idx, at_devices_to_reinit_cmd, flash_state, key_to_global_item_idx_map, monitor_states, monitor_generations, web_ui_process, numeric_step_memory, record_toggle_states, background_processes
+    t0 = time.perf_counter_ns()
+    with state_lock:
+        try: _handle_key(deck_param, k_idx, pressed)
+        finally: prof_stats["cb_ns"] += time.perf_counter_ns() - t0; prof_stats["callbacks"] += 1
+
+def _handle_key(deck_param, k_idx, pressed):
+    global page_index, numeric_mode, numeric_var, active_device_key, labels, cmds, flags, items, toggle_keys, current_session_vars, press_times, long_press_numeric_active, up_key_idx, down_key_idx, load_key_idx, at_devices_to_reinit_cmd, flash_state, monitor_states, monitor_generations, web_ui_process, numeric_step_memory, record_toggle_states, background_processes
     
-    if pressed: press_times[k_idx] = time.time(); return
-    duration = time.time()-press_times.pop(k_idx,time.time()); lp = duration>=LONG_PRESS_THRESHOLD
+    if pressed: press_times[k_idx] = time.monotonic_ns(); return
+    now = time.monotonic_ns(); lp = now-press_times.pop(k_idx,now) >= LONG_PRESS_THRESHOLD_NS
 
     # --- MODIFIED: Centralized variable definition at the start ---
-    g_idx_cb = key_to_global_item_idx_map.get(k_idx)
-    item_data, orig_item_cmd_from_db, lbl_str, flag_str = {}, "", "", ""
-    if g_idx_cb is not None and g_idx_cb < len(items):
-        item_data = items[g_idx_cb]
-        orig_item_cmd_from_db = item_data.get('command','')
-        lbl_str = item_data.get('label','')
-        flag_str = item_data.get('flags','')
+    cfg = key_cfg[k_idx] if k_idx < len(key_cfg) else None
+    g_idx_cb = cfg.g_idx if cfg else None
+    item_data = items[g_idx_cb] if g_idx_cb is not None and g_idx_cb < len(items) else {}
+    active_lbl = active_device_info.label
     
     # Numeric mode intercepts all key presses until it is deactivated.
     if numeric_mode and long_press_numeric_active:
@@ -937,18 +1618,19 @@ def callback(deck_param, k_idx, pressed):
             numeric_mode, numeric_var, long_press_numeric_active = False, None, False
             toggle_keys.clear()
             build_page(page_index); return
-        elif k_idx in [up_key_idx, down_key_idx]: # Up/Down keys adjust the variable
+        elif k_idx in (up_key_idx, down_key_idx): # Up/Down keys adjust the variable
             step = numeric_var['step'] * (5 if lp else 1)
-            curr_val = current_session_vars.get(numeric_var['name'], "0")
+            nv_name = numeric_var['name']
+            curr_val = current_session_vars.get(nv_name, "0")
             try: curr = float(curr_val)
             except ValueError: curr = 0.0
             new = curr + step if k_idx == up_key_idx else curr - step
-            current_session_vars[numeric_var['name']] = new
+            current_session_vars[nv_name] = new
             cmd_run = resolve_command_string(numeric_var['cmd_template'], current_session_vars)
             if numeric_var.get('is_background'):
                 subprocess.Popen(shlex.split(cmd_run))
             else:
-                run_cmd_in_terminal(cmd_run, act_at_lbl=labels.get(active_device_key), force_local_execution=numeric_var.get('force_local', False))
+                queue_cmd_in_terminal(cmd_run, act_at_lbl=active_lbl, force_local_execution=numeric_var.get('force_local', False))
             build_page(page_index); return
         else: # Any other key press also deactivates numeric mode
             numeric_mode, numeric_var, long_press_numeric_active = False, None, False
@@ -957,30 +1639,106 @@ def callback(deck_param, k_idx, pressed):
 
     # Fixed buttons (no g_idx) have simple, direct actions
     if g_idx_cb is None:
-        if k_idx==down_key_idx and lp:
-            if 'web_ui_process' in globals() and (web_ui_process is None or web_ui_process.poll() is not None):
-                if not WEB_UI_DIR.exists() or not(WEB_UI_DIR/"package.json").exists():return
-                try:web_ui_process=subprocess.Popen(['npm','run','dev'],cwd=WEB_UI_DIR,stdout=subprocess.PIPE,stderr=subprocess.PIPE,text=True);time.sleep(5)
-                except Exception as e:print(f"[ERROR] Failed to start Web UI server: {e}",file=sys.stderr);return
-            webbrowser.open(f"http://localhost:{REACT_APP_DEV_PORT}");return
-        if k_idx==load_key_idx and not lp:load_data_and_reinit_vars();return
-        if k_idx == up_key_idx and not lp: page_index -= 1; build_page(page_index)
-        if k_idx == down_key_idx and not lp: page_index += 1; build_page(page_index)
+        action = control_key_actions.get((k_idx, lp))
+        if action: action()
         return
+    if item_data: _run_button_key(k_idx, lp, cfg)
+
+def _confirm_button_flow(k_idx, lp, cfg, res_cmd):
+    if not execute_applescript_confirm(f"Run this command?\n\n{res_cmd}"): return # User clicked "No"
+    with state_lock:
+        if k_idx < len(key_cfg) and key_cfg[k_idx] == cfg: _run_button_key(k_idx, lp, cfg, confirmed=True)
+
+def _numeric_mode_flow(k_idx, cfg, v_n, d_v):
+    global numeric_mode, numeric_var, long_press_numeric_active
+    last_step = numeric_step_memory.get(k_idx, "1")
+    s_v_s, stp_s = execute_applescript_multi_dialog([(f"START {v_n}:", current_session_vars.get(v_n, d_v)), (f"STEP {v_n}:", last_step)], stop_on_cancel=True)
+    if not s_v_s or not stp_s: return
+    try: s_v, stp_v = float(s_v_s), float(stp_s)
+    except ValueError: return
+    with state_lock:
+        if k_idx >= len(key_cfg) or key_cfg[k_idx] != cfg: return
+        numeric_step_memory[k_idx] = stp_s
+        _, _, _, _, _, force_local_cb, is_mobile_ssh_cb, _, _, background_flag, _, _ = cfg.parsed
+        current_session_vars[v_n] = s_v; numeric_mode = True; long_press_numeric_active = True
+        numeric_var = {"name": v_n, "value": s_v, "step": stp_v, "cmd_template": cfg.cmd, "key": k_idx, "force_local": force_local_cb, "is_mobile_ssh": is_mobile_ssh_cb, "is_background": background_flag}
+        toggle_keys.clear(); toggle_keys.add(k_idx); build_page(page_index)
+
+def _record_start_followup(recpath, target_window_title, final_command):
+    # Runs on the terminal worker after the start command, so the REC window has its output.
+    time.sleep(0.5)
+    terminal_output = get_terminal_output(target_window_title)
+    log_content = final_command
+    prefix = "CMD"
+    if terminal_output:
+        match = REC_START_OUTPUT_PATTERN.search(terminal_output)
+        if match:
+            log_content = match.group(1).strip()
+            prefix = "START_OUTPUT"
+    log_to_recpath(recpath, prefix, log_content)
+
+def _record_stop_flow(g_idx_cb, recpath, target_window_title):
+    # Runs on the terminal worker; the key keeps flashing as RECORDING (marked "stopping") until the output has been checked.
+    send_keystroke_to_terminal(target_window_title, "\\r"); time.sleep(0.5)
+    terminal_output = get_terminal_output(target_window_title)
+
+    has_error = False
+    if terminal_output:
+        error_keywords = ["failed", "bad output", "MovieSamplerCheckMovie failed", "-12848"]
+        for line in terminal_output.split('\n')[-15:]:
+            if any(keyword.lower() in line.lower() for keyword in error_keywords):
+                has_error = True
+                log.info("Recording error detected in window '%s'.", target_window_title)
+                if recpath: log_to_recpath(recpath, "ERR", line.strip())
+                break
 
-    # All standard button logic from here
-    _, dev_cb, _, bg_cb, _, force_local_cb, is_mobile_ssh_cb, osa_mon_flag, record_flag, background_flag, confirm_flag, _ = parse_flags(flag_str)
+    with state_lock:
+        if not record_toggle_states.get(g_idx_cb, {}).get("stopping"): return
+        if has_error:
+            record_toggle_states[g_idx_cb] = {"state": "ERROR"}
+        else:
+            try:
+                current_take_num = int(current_session_vars.get('TAKE', "1"))
+                current_session_vars['TAKE'] = str(current_take_num + 1)
+            except (ValueError, TypeError):
+                current_session_vars['TAKE'] = "1" # Reset if not a number
+            record_toggle_states.pop(g_idx_cb, None)
+        build_page(page_index)
+
+def _start_osa_monitor(g_idx_cb, keyword, future):
+    """Done callback for the OSA spawn script: starts watching the new window, or marks the key OSA_ERROR."""
+    result_str = future.result() if not future.cancelled() and future.exception() is None else None
+    with state_lock:
+        if result_str and "::::" in result_str:
+            window_id_str,initial_snapshot=result_str.split("::::",1)
+            if window_id_str.isdigit():
+                window_id=int(window_id_str);set_monitor_state(g_idx_cb,'OSA_MONITORING');gen_id=new_monitor_generation(g_idx_cb)
+                thread=threading.Thread(target=monitor_window_snapshot,args=(g_idx_cb,window_id,initial_snapshot,keyword,gen_id),daemon=True)
+                monitor_threads[g_idx_cb]=thread;thread.start()
+            else:
+                set_monitor_state(g_idx_cb,'OSA_ERROR')
+        else:
+            set_monitor_state(g_idx_cb,'OSA_ERROR')
+
+def _run_button_key(k_idx, lp, cfg, confirmed=False):
+    """Runs a configured button's action; called with state_lock held. Anything that waits on the user or a
+    terminal is handed to the dialog or terminal worker, which re-takes state_lock to apply its result."""
+    g_idx_cb = cfg.g_idx
+    if g_idx_cb >= len(items): return
+    item_data = items[g_idx_cb]
+    orig_item_cmd_from_db, lbl_str, fm = cfg.cmd, cfg.label, cfg.mask
+    active_lbl, active_cmd_tpl = active_device_info.label, active_device_info.cmd
+    _, dev_cb, _, bg_cb, _, force_local_cb, is_mobile_ssh_cb, osa_mon_flag, record_flag, background_flag, confirm_flag, _ = cfg.parsed
 
     res_cmd = resolve_command_string(orig_item_cmd_from_db, current_session_vars)
 
     # --- MODIFIED: New flag handlers ---
-    if confirm_flag:
-        if not execute_applescript_confirm(f"Run this command?\n\n{res_cmd}"):
-            return # User clicked "No"
+    if confirm_flag and not confirmed:
+        run_dialog_flow(_confirm_button_flow, k_idx, lp, cfg, res_cmd); return
 
     if background_flag:
         if g_idx_cb in background_processes and background_processes[g_idx_cb].poll() is None:
-            print(f"[INFO] Terminating background process for button {g_idx_cb}.")
+            log.info("Terminating background process for button %s.", g_idx_cb)
             background_processes[g_idx_cb].terminate()
             try:
                 background_processes[g_idx_cb].wait(timeout=2)
@@ -992,24 +1750,23 @@ def callback(deck_param, k_idx, pressed):
                 final_bg_cmd = ""
                 if active_device_key is not None and not force_local_cb:
                     # Execute on remote device
-                    active_at_cmd = resolve_command_string(cmds.get(active_device_key, ""), current_session_vars)
-                    _, _, _, _, _, _, active_at_is_mobile, _, _, _, _, _ = parse_flags(flags.get(active_device_key, ""))
+                    active_at_cmd = resolve_command_string(active_cmd_tpl, current_session_vars)
+                    active_at_is_mobile = active_device_info.parsed[6]
                     if active_at_is_mobile:
                         active_at_cmd = _transform_ssh_user_for_mobile(active_at_cmd)
                     
-                    ssh_match = re.match(r"^(ssh\s+\S+)", active_at_cmd)
-                    if ssh_match:
-                        ssh_base = ssh_match.group(1)
+                    ssh_base = ssh_head(active_at_cmd)
+                    if ssh_base:
                         escaped_res_cmd = res_cmd.replace('"', '\\"')
                         final_bg_cmd = f'{ssh_base} "{escaped_res_cmd}"'
-                        print(f"[INFO] Executing remote background command: {final_bg_cmd}")
+                        log.info("Executing remote background command: %s", final_bg_cmd)
                     else:
                         print(f"[ERROR] Background task failed: Active @ device is not a valid SSH command.")
                         return
                 else:
                     # Execute locally
                     final_bg_cmd = res_cmd
-                    print(f"[INFO] Executing local background command: {final_bg_cmd}")
+                    log.info("Executing local background command: %s", final_bg_cmd)
 
                 proc = subprocess.Popen(shlex.split(final_bg_cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
                 background_processes[g_idx_cb] = proc
@@ -1029,37 +1786,9 @@ def callback(deck_param, k_idx, pressed):
         state_info = record_toggle_states.get(g_idx_cb, {"state": "OFF"})
         current_state = state_info.get("state", "OFF")
 
-        if lp: # Long Press to edit variables
+        if lp: # Long Press to edit variables (dialogs run on the dialog worker)
             if current_state == "RECORDING": return
-            
-            original_scene_value = str(current_session_vars.get('SCENE', ''))
-            
-            variables_to_edit = [match for match in VAR_PATTERN.finditer(orig_item_cmd_from_db) if match.group(1).upper() != 'TAKE']
-            for match in variables_to_edit:
-                var_name = match.group(1).strip()
-                default_val = match.group(3) if match.group(3) is not None else ""
-                current_val = str(current_session_vars.get(var_name, default_val))
-                user_input = execute_applescript_dialog(f"Enter value for {var_name}:", current_val)
-                if user_input is None or user_input in ["USER_CANCELLED_PROMPT", "USER_TIMEOUT_PROMPT"]:
-                    build_page(page_index); return
-                if user_input != current_val:
-                    current_session_vars[var_name] = user_input
-
-            new_scene_value = str(current_session_vars.get('SCENE', ''))
-            scene_changed = original_scene_value != new_scene_value
-            
-            take_match = re.search(r'\{\{TAKE:([^}]+)\}\}', orig_item_cmd_from_db, re.IGNORECASE)
-            default_take_str = "1"
-            if take_match and take_match.group(1).isdigit():
-                default_take_str = take_match.group(1)
-            
-            suggested_take = default_take_str if scene_changed else str(current_session_vars.get('TAKE', default_take_str))
-            prompt_message_take = f"SCENE changed. Reset TAKE or enter new value:" if scene_changed else "Enter TAKE number:"
-            
-            user_input_take = execute_applescript_dialog(prompt_message_take, suggested_take)
-            if user_input_take and user_input_take not in ["USER_CANCELLED_PROMPT", "USER_TIMEOUT_PROMPT"]:
-                current_session_vars['TAKE'] = user_input_take
-            build_page(page_index); return
+            run_dialog_flow(_edit_record_vars_flow, orig_item_cmd_from_db); return
 
         if current_state == "ERROR":
             record_toggle_states.pop(g_idx_cb, None)
@@ -1069,151 +1798,92 @@ def callback(deck_param, k_idx, pressed):
             if active_device_key is None:
                 print("[ERROR] REC Start: No active @-device selected."); record_toggle_states[g_idx_cb] = {"state": "ERROR"}; build_page(page_index); return
             
-            active_at_cmd = resolve_command_string(cmds.get(active_device_key, ""), current_session_vars)
-            _, _, _, _, _, _, active_at_is_mobile, _, _, _, _, _ = parse_flags(flags.get(active_device_key, ""))
-            final_command = resolve_command_string(orig_item_cmd_from_db, current_session_vars)
+            active_at_cmd = resolve_command_string(active_cmd_tpl, current_session_vars)
+            active_at_is_mobile = active_device_info.parsed[6]
+            final_command = res_cmd
 
             target_window_title = ""
             if active_at_is_mobile:
-                target_window_title = labels.get(active_device_key)
-                run_cmd_in_terminal(final_command, act_at_lbl=target_window_title)
+                target_window_title = active_lbl
+                queue_cmd_in_terminal(final_command, act_at_lbl=target_window_title)
             else:
                 target_window_title = f"{lbl_str}-REC"
-                print(f"[INFO] * button '{lbl_str}' targeting non-mobile @-device. Spawning new mobile session for recording.")
+                log.info("* button '%s' targeting non-mobile @-device. Spawning new mobile session for recording.", lbl_str)
                 mobile_ssh_cmd = _transform_ssh_user_for_mobile(active_at_cmd)
                 btn_cfg_for_new_win = {"lbl": target_window_title, "bg_hex": bg_cb, "text_color_name": text_color(bg_cb)}
-                run_cmd_in_terminal("", is_n_staged=True, ssh_staged=mobile_ssh_cmd, n_staged=final_command, btn_style_cfg=btn_cfg_for_new_win)
+                queue_cmd_in_terminal("", is_n_staged=True, ssh_staged=mobile_ssh_cmd, n_staged=final_command, btn_style_cfg=btn_cfg_for_new_win)
             
-            time.sleep(0.5)
-            if recpath:
-                terminal_output = get_terminal_output(target_window_title)
-                log_content = final_command
-                prefix = "CMD"
-                if terminal_output:
-                    match = re.search(r"(Will capture.*?Session start status: 0)", terminal_output, re.DOTALL)
-                    if match:
-                        log_content = match.group(1).strip()
-                        prefix = "START_OUTPUT"
-                log_to_recpath(recpath, prefix, log_content)
+            if recpath: _terminal_executor.submit(_record_start_followup, recpath, target_window_title, final_command)
 
             record_toggle_states[g_idx_cb] = {"state": "RECORDING", "window_title": target_window_title}
             build_page(page_index); return
 
         elif current_state == "RECORDING":
+            if state_info.get("stopping"): log.info("REC stop for button %s already in progress.", g_idx_cb); return
             target_window_title = state_info.get("window_title")
             if not target_window_title:
                 print("[ERROR] REC Stop: Cannot find window title from recording start."); record_toggle_states[g_idx_cb] = {"state": "ERROR"}; build_page(page_index); return
 
-            send_keystroke_to_terminal(target_window_title, "\\r"); time.sleep(0.5)
-            terminal_output = get_terminal_output(target_window_title)
-            
-            has_error = False
-            if terminal_output:
-                error_keywords = ["failed", "bad output", "MovieSamplerCheckMovie failed", "-12848"]
-                for line in terminal_output.split('\n')[-15:]:
-                    if any(keyword.lower() in line.lower() for keyword in error_keywords):
-                        has_error = True
-                        print(f"[INFO] Recording error detected in window '{target_window_title}'.")
-                        if recpath: log_to_recpath(recpath, "ERR", line.strip())
-                        break
-            
-            if has_error:
-                record_toggle_states[g_idx_cb] = {"state": "ERROR"}
-            else:
-                try:
-                    current_take_num = int(current_session_vars.get('TAKE', "1"))
-                    current_session_vars['TAKE'] = str(current_take_num + 1)
-                except (ValueError, TypeError):
-                    current_session_vars['TAKE'] = "1" # Reset if not a number
-                record_toggle_states.pop(g_idx_cb, None)
-            
-            build_page(page_index); return
+            record_toggle_states[g_idx_cb] = {"state": "RECORDING", "window_title": target_window_title, "stopping": True}
+            _terminal_executor.submit(_record_stop_flow, g_idx_cb, recpath, target_window_title); return
         return
 
     if osa_mon_flag and not lp:
         current_mon_state = monitor_states.get(g_idx_cb)
         if current_mon_state in ["OSA_MONITORING", "OSA_FOUND"]:
-            print(f"[INFO] User cancelled/dismissed OSA monitor for button {g_idx_cb}.")
-            monitor_generations[g_idx_cb] = None
-            monitor_states.pop(g_idx_cb, None)
-            redraw()
+            log.info("User cancelled/dismissed OSA monitor for button %s.", g_idx_cb)
+            cancel_monitor(g_idx_cb)
+            set_monitor_state(g_idx_cb, None)
             return
 
         if g_idx_cb in monitor_threads and monitor_generations.get(g_idx_cb) is not None:
-             monitor_generations[g_idx_cb] = None; time.sleep(0.1)
+             cancel_monitor(g_idx_cb); time.sleep(0.1)
 
         keyword=item_data.get('monitor_keyword',''); keyword = keyword[:-2] if keyword.endswith(".0") else keyword
         if not keyword:
-            monitor_states[g_idx_cb]='OSA_ERROR'; print("[ERROR] OSA Monitor keyword is missing."); redraw(); return
+            set_monitor_state(g_idx_cb,'OSA_ERROR'); print("[ERROR] OSA Monitor keyword is missing."); return
 
-        command_to_run=resolve_command_string(orig_item_cmd_from_db,current_session_vars)
-        style={"lbl":lbl_str,"bg_hex":bg_cb,"text_color_name":text_color(bg_cb)}; result_str=None
+        command_to_run=res_cmd
+        style={"lbl":lbl_str,"bg_hex":bg_cb,"text_color_name":text_color(bg_cb)}; future=None
         
         if active_device_key is not None:
-            ssh_cmd=resolve_command_string(cmds.get(active_device_key,""),current_session_vars)
+            ssh_cmd=resolve_command_string(active_cmd_tpl,current_session_vars)
             if ssh_cmd:
-                result_str=run_cmd_in_terminal("",btn_style_cfg=style,script_template_override="spawn_ssh_and_snapshot",ssh_cmd_to_keystroke=ssh_cmd,actual_cmd_to_keystroke=command_to_run)
+                future=queue_cmd_in_terminal("",btn_style_cfg=style,script_template_override="spawn_ssh_and_snapshot",ssh_cmd_to_keystroke=ssh_cmd,actual_cmd_to_keystroke=command_to_run)
         else:
-            result_str=run_cmd_in_terminal(command_to_run,btn_style_cfg=style,script_template_override="spawn_and_snapshot")
+            future=queue_cmd_in_terminal(command_to_run,btn_style_cfg=style,script_template_override="spawn_and_snapshot")
         
-        if result_str and "::::" in result_str:
-            window_id_str,initial_snapshot=result_str.split("::::",1)
-            if window_id_str.isdigit():
-                window_id=int(window_id_str);monitor_states[g_idx_cb]='OSA_MONITORING';gen_id=time.time();monitor_generations[g_idx_cb]=gen_id
-                thread=threading.Thread(target=monitor_window_snapshot,args=(g_idx_cb,window_id,initial_snapshot,keyword,gen_id),daemon=True)
-                monitor_threads[g_idx_cb]=thread;thread.start()
-            else:
-                monitor_states[g_idx_cb]='OSA_ERROR'
-        else:
-            monitor_states[g_idx_cb]='OSA_ERROR'
-        redraw();return
+        if future is None: set_monitor_state(g_idx_cb,'OSA_ERROR')
+        else: future.add_done_callback(lambda f: _start_osa_monitor(g_idx_cb, keyword, f))
+        return
     
-    if'#'in flag_str: # --- MODIFIED: Corrected to handle short-press
+    if fm & FLAG_HASH: # --- MODIFIED: Corrected to handle short-press
         if lp: # Long-press enters numeric adjustment mode
-            m=VAR_PATTERN.search(orig_item_cmd_from_db)
-            if not m:return
-            v_n,d_v=m.group(1).strip(),m.group(3)or"0";s_v_s=execute_applescript_dialog(f"START {v_n}:",current_session_vars.get(v_n,d_v))
-            if not s_v_s or s_v_s in["USER_CANCELLED_PROMPT","USER_TIMEOUT_PROMPT",None]:redraw();return
-            last_step=numeric_step_memory.get(k_idx,"1");stp_s=execute_applescript_dialog(f"STEP {v_n}:",last_step)
-            if not stp_s or stp_s in["USER_CANCELLED_PROMPT","USER_TIMEOUT_PROMPT",None]:redraw();return
-            try:s_v,stp_v=float(s_v_s),float(stp_s);numeric_step_memory[k_idx]=stp_s
-            except:redraw();return
-            current_session_vars[v_n]=s_v;numeric_mode=True;long_press_numeric_active=True
-            numeric_var={"name":v_n,"value":s_v,"step":stp_v,"cmd_template":orig_item_cmd_from_db,"key":k_idx,"force_local":force_local_cb,"is_mobile_ssh":is_mobile_ssh_cb, "is_background": background_flag}
-            toggle_keys.clear();toggle_keys.add(k_idx);build_page(page_index);return
+            specs=cmd_var_specs(orig_item_cmd_from_db)
+            if not specs:return
+            run_dialog_flow(_numeric_mode_flow,k_idx,cfg,specs[0][0].strip(),specs[0][1]or"0");return
         else: # Short-press just runs the command once
-            run_cmd_in_terminal(res_cmd, act_at_lbl=labels.get(active_device_key), force_local_execution=force_local_cb)
+            queue_cmd_in_terminal(res_cmd, act_at_lbl=active_lbl, force_local_execution=force_local_cb)
 
     elif dev_cb and not lp:
         style={"lbl":lbl_str,"bg_hex":bg_cb,"text_color_name":text_color(bg_cb)};force=k_idx in at_devices_to_reinit_cmd
-        if force:at_devices_to_reinit_cmd.remove(k_idx)
-        if active_device_key==k_idx and not force:active_device_key=None;toggle_keys.discard(k_idx)
+        if force:at_devices_to_reinit_cmd.discard(k_idx)
+        if active_device_key==k_idx and not force:set_active_device(None);toggle_keys.discard(k_idx)
         else:
             if active_device_key is not None:toggle_keys.discard(active_device_key)
-            active_device_key=k_idx;toggle_keys.add(k_idx)
-            cmd_r=resolve_command_string(orig_item_cmd_from_db,current_session_vars)
-            if is_mobile_ssh_cb and cmd_r.lower().strip().startswith("ssh ") and not force_local_cb:cmd_r=_transform_ssh_user_for_mobile(cmd_r)
-            run_cmd_in_terminal(cmd_r,is_at_act=True,at_has_n=('N' in flag_str),btn_style_cfg=style,force_new_win_at=force,force_local_execution=force_local_cb)
+            set_active_device(k_idx);toggle_keys.add(k_idx)
+            cmd_r=res_cmd
+            if is_mobile_ssh_cb and not force_local_cb:cmd_r=_transform_ssh_user_for_mobile(cmd_r)
+            queue_cmd_in_terminal(cmd_r,is_at_act=True,at_has_n=bool(fm & FLAG_N),btn_style_cfg=style,force_new_win_at=force,force_local_execution=force_local_cb)
         build_page(page_index);return
         
-    elif'V'in flag_str.upper() and lp:
-        v_f=list(VAR_PATTERN.finditer(orig_item_cmd_from_db))
-        if not v_f:return
-        chg=False
-        for m in v_f:
-            v_n,d_v=m.group(1).strip(),m.group(3)or"";c_v=str(current_session_vars.get(v_n,d_v))
-            n_v=execute_applescript_dialog(f"Val for {v_n}:",c_v)
-            if n_v and n_v not in["USER_CANCELLED_PROMPT","USER_TIMEOUT_PROMPT",None] and n_v!=c_v:current_session_vars[v_n]=n_v;chg=True
-        if dev_cb:
-            at_devices_to_reinit_cmd.add(k_idx)
-            if k_idx==active_device_key and chg:active_device_key=None;toggle_keys.discard(k_idx)
-        build_page(page_index);return
+    elif fm & FLAG_V and lp:
+        if not cmd_var_specs(orig_item_cmd_from_db):return
+        run_dialog_flow(_edit_button_vars_flow,k_idx,cfg,dev_cb);return
     
     # This is the final, generic command execution for simple buttons
-    elif not any([dev_cb, record_flag, osa_mon_flag, '#' in flag_str]):
-        run_cmd_in_terminal(res_cmd, act_at_lbl=labels.get(active_device_key), force_local_execution=force_local_cb)
-
-    redraw()
+    elif not (dev_cb or record_flag or osa_mon_flag or fm & FLAG_HASH):
+        queue_cmd_in_terminal(res_cmd, act_at_lbl=active_lbl, force_local_execution=force_local_cb)
 
 # --- Main Execution Block ---
 if __name__ == "__main__":
@@ -1225,29 +1895,49 @@ if __name__ == "__main__":
         print(f"[INFO] Opened Stream Deck: {deck.deck_type()} ({deck.key_count()} keys)")
     except Exception as e: print(f"[FATAL] Deck init error: {e}"); sys.exit(1)
     cnt = deck.key_count(); rows_sd, cols_sd = deck.key_layout()
+    start_key_image_writer()
     load_key_idx = 0; up_key_idx = cols_sd if cnt >= 15 else (1 if cnt == 6 else None); down_key_idx = 2 * cols_sd if cnt >= 15 else (4 if cnt == 6 else None)
     print(f"[INFO] Layout: {rows_sd}r,{cols_sd}c. L:{load_key_idx},U:{up_key_idx},D:{down_key_idx}")
+    control_key_actions = build_control_key_actions()
     
     flask_server_thread = threading.Thread(target=run_flask_app_thread, daemon=True); flask_server_thread.start()
     
     # ##################################################################
     # ##### RUNNING THE NEW SETUP SCRIPTS ON INITIAL LAUNCH #####
     # ##################################################################
+    # Setup scripts and the DB load block on osascript/Numbers; load fonts meanwhile.
+    threading.Thread(target=warm_font_cache, name="sd-fonts", daemon=True).start()
     run_initial_setup_scripts()
 
-    load_data_and_reinit_vars()
+    load_data_and_reinit_vars(rebuild_db=not db_has_streamdeck_table())
     deck.set_key_callback(callback)
     redraw()
     print("[INFO] Stream Deck initialized. Listening for key presses...")
+    def _request_stop(*_): stop_event.set(); ui_wake.set()
+    signal.signal(signal.SIGINT, _request_stop); signal.signal(signal.SIGTERM, _request_stop)
+    if hasattr(signal, "SIGUSR1"): signal.signal(signal.SIGUSR1, dump_prof_stats)
     try:
-        while True:
-            flash_state = not flash_state
+        # The deck library delivers key presses on its own thread; the main thread repaints keys
+        # queued via ui_wake and, only while something flashes, toggles flash_state on a fixed cadence.
+        next_flash = time.monotonic() + FLASH_INTERVAL
+        while not stop_event.is_set():
+            animating = needs_animation()
+            deadlines = [d for d in (next_flash if animating else None, page_rebuild_due) if d is not None]
+            if ui_wake.wait(max(0.0, min(deadlines) - time.monotonic()) if deadlines else None): ui_wake.clear()
+            rebuild_page_if_pending(); redraw_dirty()
+            if stop_event.is_set(): break
+            if not animating: next_flash = time.monotonic() + FLASH_INTERVAL; continue
+            if time.monotonic() < next_flash: continue
+            next_flash = time.monotonic() + FLASH_INTERVAL
+            flash_state = not flash_state; t0 = time.perf_counter_ns()
             # --- NEW: Check status of background processes ---
             for g_idx in list(background_processes.keys()):
                 if background_processes[g_idx].poll() is not None:
-                    del background_processes[g_idx]
-            
-            redraw(); time.sleep(POLL_INTERVAL)
+                    del background_processes[g_idx]; request_redraw(g_idx)
+
+            mark_dirty(*flashing_keys()); prof_stats["flash_ns"] += time.perf_counter_ns() - t0
+            redraw_dirty()
+        print("\n[INFO] Stop signal received: Exiting...")
     except KeyboardInterrupt: print("\n[INFO] KeyboardInterrupt: Exiting...")
     finally:
         print("[INFO] Cleaning up...")
@@ -1265,5 +1955,8 @@ if __name__ == "__main__":
                 except subprocess.TimeoutExpired:
                     proc.kill()
 
+        cancel_all_monitors()
+        flush_recpath_logs(); close_db()
+        stop_key_image_writer()
         if deck: deck.reset(); deck.close()
         print("[INFO] Exited.")